@@ -1,247 +1,485 @@
-import cplex
+from collections import defaultdict
 from math import log
+import time
+import numpy as np
+from algorithm.solver import MILP, check_backend
 
-class LiveJack(object):
-    def __init__(self, topology, channels, viewers):
-        self.topology = topology
-
-        self.G = topology.G
-        self.node_number = self.G.number_of_nodes()
-
-        # transfer id based channel to map
-        # [{'sites'->{nodes}, 'bw'->float, 'src'->node}]
-        self.channels = [None] * len(channels)
-        self.channel_map = [None] * len(channels)
-
-        self.qoe_cost = None  # TODO: qoe cost
-        self.cost_thres = None
-
-        channel_cnt = 0
-
-        for channel_id in self.channel:
-            self.channel_map[channel_cnt] = channel_id
-            channels[channel_cnt] = channels[channel_id]
-            channel_cnt = channel_cnt + 1
+# Bandwidth of one stream, the unit main.py charges links with for a tree edge or a viewer
+CHANNEL_BANDWIDTH = 100
+# Objective cost per unit of link or server overload, so overload is only chosen when nothing else fits
+OVERLOAD_PENALTY = 1e6
 
-        # record only the viewers that are directly connected to the server
-        self.viewers = viewers
 
-        # [channel_id -> vmf site, ... ]
-        self.local_viewer_map = [{}] * self.node_number
-
-    def __serial__(self, channel_id, src, dst):
-        return channel_id * self.node_number * self.node_number + \
-            src * self.node_number + dst
-
-    def __deserial__(self, var_id):
-        return [var_id / (self.node_number * self.node_number),
-                var_id % (self.node_number * self.node_number)/self.node_number,
-                var_id % (self.node_number)]
+class LiveJack(object):
+    """VMF site selection and delivery tree placement, each solved as one MILP over the round's channels.
+
+    Same interface as Multicast, so it runs as simulate(..., algorithm=LiveJack); bind backend='cbc' or 'cplex',
+    a time limit or method='heuristic' with a per-round budget or steps with functools.partial. The current sites and
+    trees are the previous round's solution and are handed to the solver as its starting point.
+    """
+    def __init__(self, topology, trace, system, events, backend='highs', time_limit=None, qoe_cost=None,
+                 cost_thres=np.inf, method='milp', budget=None, steps=None, compare=False, report=None):
+        self.topology = topology
+        self.trace = trace
+        self.system = system
+        self.events = events
+        self.backend = backend
+        self.time_limit = time_limit
+        self.threads = 1
+        # 'milp' solves both stages exactly, 'heuristic' runs greedy placement and local search until no move
+        # helps, or until budget wall-clock seconds or steps candidate moves per round are used up. Only steps
+        # stops at the same point on every machine.
+        self.method = method
+        self.budget = budget
+        self.steps = steps
+        self.search_budget = None
+        # With compare, heuristic answers are also solved exactly and the gap goes to report
+        self.compare = compare
+        # List that gets one dict per solved stage: objective, exact objective and bound when known, gap, seconds,
+        # and search steps used so far this round for the heuristic
+        self.report = report
+        if method != 'heuristic' or compare:
+            # Fail before the round starts rather than at the first solve
+            check_backend(backend)
+
+        self.node_number = topology.number_of_nodes
+        self.servers = np.array(sorted(topology.servers))
+        # qoe_cost[server][position], network distance unless a measured table is given
+        self.qoe_cost = topology.hops if qoe_cost is None else qoe_cost
+        # Positions farther than this from every site are served by the channel source
+        self.cost_thres = cost_thres
+
+    def compute(self, incremental=True, workers=1):
+        self.threads = workers
+        self.search_budget = _SearchBudget(None if self.budget is None else time.time() + self.budget, self.steps)
+        # (position, channel) -> new viewers without an access point, channel -> all new viewers
+        unassigned = defaultdict(int)
+        viewer_delta = defaultdict(int)
+        for new_viewer_id in self.events[2]:
+            position, channel, access_point = self.trace.viewers[new_viewer_id]
+            viewer_delta[channel] += 1
+            if (position, channel) not in self.system.access_point:
+                unassigned[(position, channel)] += 1
 
-    def __serial_vmf_assign__(self, channel_id, site_id=None,
-                              viewer_id=None):
-        if viewer_id is None:
-            return len(self.channels) + self.node_number * self.node_number + \
-               channel_id * self.node_number + site_id
-        else:
-            return channel_id * self.node_number + site_id
-
-    def __deserial_vmf_assign__(self, var_id, is_assign=True):
-        if is_assign:
-            return [var_id / (self.node_number * self.node_number),
-                    var_id % (self.node_number * self.node_number) /
-                    self.node_number,
-                    var_id % (self.node_number)]
-        else:
-            var_id = var_id - self.node_number * self.node_number *\
-                len(self.channels)
-            return [var_id / self.node_number,
-                    var_id % self.node_number]
+        # based on sites, calculate local decision
+        sites = self.assign_sites(unassigned, viewer_delta)
+        channels_with_new_delivery_tree = set()
+        for position, channel in sorted(unassigned):
+            site = self.local_site(position, channel, sites[channel])
+            self.system.set_access_point(position, channel, {site: 1})
+            if site != self.system.channels[channel]['src'] and site not in self.system.channels[channel]['sites']:
+                self.system.channels[channel]['sites'].append(site)
+                channels_with_new_delivery_tree.add(channel)
 
-    def __cal_route__(self, routing):
-        for (link_src, link_dst) in self.G.edges():
-            self.G[link_src][link_dst]['routes'] = set()
+        for new_viewer_id in self.events[2]:
+            position, channel, access_point = self.trace.viewers[new_viewer_id]
+            self.trace.viewers[new_viewer_id][2] = self.system.access_point.get(position, channel).keys()[0]
 
-        for src in range(self.node_number):
-            for dst in range(self.node_number):
-                path = self.topology.routing[src][dst]
+        new_delivery_tree = self.delivery_tree(sorted(channels_with_new_delivery_tree), incremental)
+        return channels_with_new_delivery_tree, new_delivery_tree
 
-                for idx in range(len(path)-1):
-                    link_src = path[idx]
-                    link_dst = path[idx+1]
-                    self.G[link_src][link_dst]['routes'].add((src, dst))
+    def terminals(self, channel):
+        return [self.system.channels[channel]['src']] + self.system.channels[channel]['sites']
 
     def site_delta_constraints(self, viewer_delta):
+        # Number of new sites a channel may open this round, growing with the log of its new viewers
         thres_flash_crowds = 10000
 
         if (viewer_delta >= thres_flash_crowds):
             return self.node_number
         else:
-            return int(log(viewer_delta)/log(thres_flash_crowds) *
+            return int(log(max(viewer_delta, 1))/log(thres_flash_crowds) *
                        self.node_number)
 
-    def delivery_tree(self):
-        prob = cplex.Cplex()
-
-        prob.objective.set_sense(prob.objective.sense.minimize)
-
-        rows = []
-        cols = []
-        vals = []
-        my_rhs = []
-        row_offset = 0
-        my_ub = [1] * len(self.channels) * self.node_number * self.node_number
-        my_lb = [0] * len(self.channels) * self.node_number * self.node_number
-        my_ctype = "I" * len(self.channels) * \
-            self.node_number * self.node_number
-        my_sense = ""
-
-        # tree constraint
-        for channel_id in self.channels:
-            for src in range(self.node_number):
-                for dst in range(self.node_number):
-                    if (src != dst):
-                        rows.append(row_offset)
-                        cols.append(self.__serial__(row_offset, src, dst))
-                        vals.append(1)
-
-                my_rhs.append(len(self.channels[channel_id]['sites']) - 1)
-
-            row_offset = row_offset + 1
-
-        my_sense = my_sense + "E" * len(self.channels)
-
-        # delivery site constraint
-        for src in range(self.node_number):
-            for channel_idx in range(len(self.channels)):
-                for dst in range(self.node_number):
-                    rows.append(row_offset)
-                    cols.append(self.__serial__(channel_idx, src, dst))
-                    vals.append(1)
-
-                if src in self.channels['sites']:
-                    my_rhs.append(1)
-                else:
-                    my_rhs.append(0)
-
-                row_offset = row_offset + 1
-
-        my_sense = my_sense + "E" * len(self.node_number)
-
-        for dst in range(self.node_number):
-            for channel_idx in range(len(self.channels)):
-                for src in range(self.node_number):
-                    rows.append(row_offset)
-                    cols.append(self.__serial__(channel_idx, src, dst))
-                    vals.append(1)
-
-                if dst in self.channels['sites']:
-                    my_rhs.append(1)
-                else:
-                    my_rhs.append(0)
-
-                row_offset = row_offset + 1
-
-        my_sense = my_sense + "E" * len(self.node_number)
-
-        # bandwidth constraint
-        for (link_src, link_dst) in self.topology.edges():
-            routes = self.topology[link_src][link_dst]['routes']
-
-            for src in range(self.node_number):
-                for dst in range(self.node_number):
-                    if (src, dst) in routes:
-                        for channel_idx in range(len(self.channels)):
-                            rows.append(row_offset)
-                            cols.append(self.__serial__(channel_idx,
-                                                        src, dst))
-                            vals.append(self.channels[channel_idx]['bw'])
-
-            my_rhs.append(self.G[link_src][link_dst])
-            row_offset = row_offset + 1
-
-        # objective
-        my_obj = []
-
-        for src in range(len(self.node_number)):
-            for dst in range(len(self.node_number)):
-                for channel_idx in range(len(self.node_number)):
-                    my_obj.append(self.channels[channel_idx]['bw'])
-
-        my_sense = my_sense + "L" * len(self.G.number_of_edges())
-
-        prob.linear_constraints.add(rhs=my_rhs, senses=my_sense)
-
-        prob.variables.add(obj=my_obj, lb=my_lb,
-                           ub=my_ub, types=my_ctype)
-
-        prob.linear_constraints.set_coefficients(zip(rows, cols, vals))
-
-        prob.solve()
-        vals = prob.solution.get_values()
-
-    def assign_sites(self):
-        # based on unassigned requests, and existing sites, calculate sites
-        prob = cplex.Cplex()
-
-        prob.objective.set_sense(prob.objective.sense.minimize)
-
-        rows = []
-        cols = []
-        vals = []
-        my_rhs = []
-        row_offset = 0
-
-        my_ub = [1] * (len(self.channels) * len(self.node_number) * \
-                       len(self.node_number),
-                       len(self.channels) * len(self.node_number))
-        my_lb = [0] * (len(self.channels) * len(self.node_number) * \
-                       len(self.node_number),
-                       len(self.channels) * len(self.node_number))
-        my_ctype = "I" * (len(self.channels) * self.node_number *
-                          self.node_number + len(self.channels) *
-                          self.node_number)
-
-        # constraints on vmf modifications
-        for channel_idx in range(len(self.channels)):
-            rhs_channel = 0
-
-            for site in range(self.node_number):
-                rows.append(row_offset)
-                cols.append(self.__serial_vmf_assign__(channel_idx,
-                                                       site))
-
-                if site in self.channels[channel_idx]['sites']:
-                    vals.append(-1)
-                    rhs_channel = rhs_channel - 1
-                else:
-                    vals.append(1)
-                    rhs_channel = rhs_channel + 1
-
-            my_rhs.append(rhs_channel)
-            row_offset = row_offset + 1
-
-        # constraints on aggregate bandwidth
-
-
-
-        # based on sites, calculate local decision
-        for channel_idx in range(len(self.channels)):
-            sites = self.channels[channel_idx]['sites']
-
-            for loc in range(self.node_number):
-                # min affinity
-                min_cost = float("inf")
-                min_site = -1
-
-                for site in sites:
-                    if self.qoe_cost[site][loc] < min_cost:
-                        min_cost = self.qoe_cost[site][loc]
-                        min_site = site
-
-                if min_cost > self.cost_thres:  # for later VMF assignment
-                    min_site = self.channels[channel_idx]['src']
-
-                channel_id = self.channel_map[channel_idx]
-
-                self.local_viewer_map[loc][channel_id] = min_site
+    def local_site(self, position, channel, sites):
+        # Closest site by qoe cost, the source when every site is too far
+        cost = self.qoe_cost[sites, position]
+        if cost.min() > self.cost_thres:
+            return self.system.channels[channel]['src']
+        return sites[int(np.argmin(cost))]
+
+    def assign_sites(self, unassigned, viewer_delta):
+        # Open sites for the channels with unassigned viewers, returns channel -> sites with the source first.
+        # The MILP (see _site_model) is only built when it is solved or compared against.
+        if not unassigned:
+            return {}
+        start_time = time.time()
+        pairs = sorted(unassigned)
+        channels = sorted(set(channel for _, channel in pairs))
+        servers = self.servers
+        channel_index = dict((channel, index) for index, channel in enumerate(channels))
+        demand_position = np.array([position for position, _ in pairs])
+        demand_channel = np.array([channel_index[channel] for _, channel in pairs])
+        demand = np.array([unassigned[pair] for pair in pairs], dtype=np.float64)
+
+        is_site = np.array([np.in1d(servers, self.terminals(channel)) for channel in channels])
+        # Stream hops from the tree to each server that is not a site yet
+        tree_hops = np.array([self.topology.hops[np.ix_(self.terminals(channel), servers)].min(axis=0)
+                              for channel in channels])
+        open_cost = np.where(is_site, 0, tree_hops)
+        qoe_cost = (demand[:, None] * self.qoe_cost[np.ix_(servers, demand_position)].T)
+        capacity = self.topology.state.server[servers]
+        # At most site_delta_constraints new sites per channel
+        delta = np.array([self.site_delta_constraints(viewer_delta[channel]) for channel in channels])
+
+        # The solver starts from the current sites, the heuristic improves on them
+        is_open = is_site
+        if self.method == 'heuristic':
+            is_open = _search_sites(is_site, open_cost, qoe_cost, demand, demand_channel, capacity, delta,
+                                    self.search_budget)
+        values = self._solve('assign_sites', start_time,
+                             lambda: _site_model(is_site, open_cost, qoe_cost, demand, demand_channel, capacity, delta),
+                             _site_values(is_open, qoe_cost, demand, demand_channel, capacity),
+                             _site_objective(is_open, open_cost, qoe_cost, demand, demand_channel, capacity))
+        if values is not None:
+            is_open = values[:is_site.size].reshape(is_site.shape) > 0.5
+        sites = {}
+        for index, channel in enumerate(channels):
+            source = self.system.channels[channel]['src']
+            sites[channel] = [source] + [int(server) for server in servers[is_open[index]] if server != source]
+        return sites
+
+    def delivery_tree(self, channels, incremental=True):
+        # Overlay tree over each channel's terminals, returns target -> source -> [channel] like Multicast.
+        # Incremental: only terminals without a parent get one, existing edges stay.
+        # Otherwise the whole tree is placed again, on top of the capacity its old edges free.
+        # The candidate edges and the MILP (see _tree_model) are only built when it is solved or compared against.
+        new_delivery_tree = defaultdict(lambda: defaultdict(list))
+        if not channels:
+            return new_delivery_tree
+        start_time = time.time()
+        topology = self.topology
+        hops = topology.hops
+        available = topology.state.capacity.astype(np.float64)
+        needs_model = self.method != 'heuristic' or self.compare
+
+        pair_channel, pair_parent, pair_child, parent_level, child_level, level_bound = [], [], [], [], [], []
+        # channel index -> (nodes, free, {free node -> parent}) for channels with free terminals
+        trees = {}
+        number_of_levels = 0
+        for index, channel in enumerate(channels):
+            nodes = np.array(self.terminals(channel))
+            old_parent = dict((target, source) for source, target in self.system.get_tree_edges(channel))
+            if incremental:
+                free = np.array([node != nodes[0] and node not in old_parent for node in nodes])
+                old_parent = {}
+            else:
+                free = np.arange(len(nodes)) > 0
+                for source, target in self.system.get_tree_edges(channel):
+                    available[topology.get_edges_on_path(source, target)] += CHANNEL_BANDWIDTH
+            number_of_free = free.sum()
+            if number_of_free == 0:
+                continue
+
+            if needs_model:
+                # Candidate edges: any terminal -> any free terminal
+                level = np.full(len(nodes), -1)
+                level[free] = number_of_levels + np.arange(number_of_free)
+                parent = np.repeat(np.arange(len(nodes)), number_of_free)
+                child = np.tile(np.nonzero(free)[0], len(nodes))
+                keep = parent != child
+                parent, child = parent[keep], child[keep]
+                pair_channel.append(np.full(len(parent), index))
+                pair_parent.append(nodes[parent])
+                pair_child.append(nodes[child])
+                parent_level.append(level[parent])
+                child_level.append(level[child])
+                level_bound.append(np.full(number_of_free, number_of_free))
+
+            # Starting tree: the old parent where it still serves, else the closest terminal already placed
+            trees[index] = (nodes, free, _start_tree(nodes.tolist(), free, old_parent, hops))
+            number_of_levels += number_of_free
+
+        if not trees:
+            return new_delivery_tree
+        if self.method == 'heuristic':
+            _search_trees(topology, trees, available, self.search_budget)
+        start = build = None
+        if needs_model:
+            pair_channel, pair_parent, pair_child, parent_level, child_level, level_bound = [
+                np.concatenate(arrays) for arrays in
+                (pair_channel, pair_parent, pair_child, parent_level, child_level, level_bound)]
+            paths = topology.incidence[pair_parent * self.node_number + pair_child]
+            start = _tree_values(trees, pair_channel, pair_parent, pair_child, paths, available)
+            build = lambda: _tree_model(hops, pair_parent, pair_child, parent_level, child_level, level_bound,
+                                        number_of_levels, paths, available)
+        values = self._solve('delivery_tree', start_time, build, start, _tree_objective(topology, trees, available))
+        if values is None:
+            for index, (nodes, free, parents) in sorted(trees.iteritems()):
+                for child, parent in parents.iteritems():
+                    new_delivery_tree[int(child)][int(parent)].append(channels[index])
+        else:
+            for pair in np.nonzero(values[:len(pair_channel)] > 0.5)[0]:
+                channel = channels[pair_channel[pair]]
+                new_delivery_tree[int(pair_child[pair])][int(pair_parent[pair])].append(channel)
+        return new_delivery_tree
+
+    def _solve(self, stage, start_time, build, start, objective):
+        # milp: build the model and solve it from start. heuristic: the caller's answer stands, its objective is
+        # reported and the model is built and solved only with compare. Returns the model values to use, None
+        # for a heuristic answer, and adds a row to report.
+        values = None
+        row = {'round': self.trace.round_no, 'stage': stage, 'method': self.method}
+        if self.method == 'heuristic':
+            row.update(objective=objective, seconds=time.time() - start_time, steps=self.search_budget.used)
+        else:
+            values = start
+            row.update(objective=objective)
+        if self.method != 'heuristic' or self.compare:
+            solution = build().solve(self.backend, start, self.time_limit, self.threads)
+            if solution is not None:
+                row.update(exact=solution.objective, bound=solution.bound)
+                if self.method != 'heuristic':
+                    values = solution.x
+                    row.update(objective=solution.objective)
+        if self.method != 'heuristic':
+            row['seconds'] = time.time() - start_time
+        if 'exact' in row:
+            # Heuristic answers against the exact one, solver answers against their proven bound
+            reference = row['exact'] if self.method == 'heuristic' else row['bound']
+            row['gap'] = (row['objective'] - reference) / max(abs(row['objective']), 1e-9)
+        if self.report is not None:
+            self.report.append(row)
+        return values
+
+
+def _site_model(is_site, open_cost, qoe_cost, demand, demand_channel, capacity, delta):
+    #   y[c][k]     server k serves channel c, fixed to 1 for current sites (the first variables)
+    #   z[d][k]     share of demand d = (position, channel) served by server k
+    #   slack[k]    viewers over server k's remaining capacity
+    # min sum viewers * qoe_cost * z + sum stream hops from the tree to each new site + penalty * slack
+    number_of_servers = is_site.shape[1]
+    number_of_demands = len(demand)
+    model = MILP()
+    y = model.add_variables(open_cost.ravel(), lower=is_site.ravel(), upper=1, integer=True)
+    z = model.add_variables(qoe_cost.ravel(), upper=1)
+    slack = model.add_variables(np.full(number_of_servers, OVERLOAD_PENALTY))
+
+    # Every demand is fully served
+    model.add_rows(number_of_demands, np.repeat(np.arange(number_of_demands), number_of_servers), z, 1, 1, 1)
+    # Only by open sites: z[d][k] <= y[channel of d][k]
+    site_of_z = y[(demand_channel[:, None] * number_of_servers + np.arange(number_of_servers)).ravel()]
+    model.add_rows(len(z), np.tile(np.arange(len(z)), 2), np.concatenate([z, site_of_z]),
+                   np.repeat([1, -1], len(z)), upper=0)
+    # Server capacity left after the viewers already attached
+    model.add_rows(number_of_servers,
+                   np.concatenate([np.tile(np.arange(number_of_servers), number_of_demands),
+                                   np.arange(number_of_servers)]),
+                   np.concatenate([z, slack]),
+                   np.concatenate([np.repeat(demand, number_of_servers), -np.ones(number_of_servers)]),
+                   upper=capacity)
+    # Constraints on vmf modifications: at most delta new sites per channel
+    new_channel, new_server = np.nonzero(~is_site)
+    model.add_rows(len(delta), new_channel, y[new_channel * number_of_servers + new_server], 1, upper=delta)
+    return model
+
+
+def _tree_model(hops, pair_parent, pair_child, parent_level, child_level, level_bound, number_of_levels, paths,
+                available):
+    #   x[c][u][v]  u delivers channel c to v (the first variables, one per candidate pair)
+    #   level[c][v] position of v below the tree's fixed part, cuts cycles (Miller-Tucker-Zemlin)
+    #   slack[e]    bandwidth over link e's capacity
+    # min sum bandwidth * hops * x + penalty * slack
+    number_of_links = paths.shape[1]
+    model = MILP()
+    x = model.add_variables(CHANNEL_BANDWIDTH * hops[pair_parent, pair_child], upper=1, integer=True)
+    levels = model.add_variables(np.zeros(number_of_levels), lower=1, upper=level_bound)
+    slack = model.add_variables(np.full(number_of_links, OVERLOAD_PENALTY))
+
+    # One parent per free terminal
+    model.add_rows(number_of_levels, child_level, x, 1, 1, 1)
+    # level[v] >= level[u] + 1 on every chosen edge between free terminals
+    inner = np.nonzero(parent_level >= 0)[0]
+    bound = level_bound[child_level[inner]]
+    model.add_rows(len(inner), np.tile(np.arange(len(inner)), 3),
+                   np.concatenate([levels[parent_level[inner]], levels[child_level[inner]], x[inner]]),
+                   np.concatenate([np.ones(len(inner)), -np.ones(len(inner)), bound]),
+                   upper=bound - 1)
+    # Link capacity
+    usage = paths.T.tocoo()
+    model.add_rows(number_of_links, np.concatenate([usage.row, np.arange(number_of_links)]),
+                   np.concatenate([x[usage.col], slack]),
+                   np.concatenate([np.full(usage.nnz, CHANNEL_BANDWIDTH), -np.ones(number_of_links)]),
+                   upper=available)
+    return model
+
+
+def _tree_objective(topology, trees, available):
+    # Model objective of the trees: stream hops plus overload, without building candidate edges
+    load = np.zeros(len(available))
+    cost = 0
+    for nodes, free, parents in trees.itervalues():
+        for child, parent in parents.iteritems():
+            load[topology.get_edges_on_path(parent, child)] += CHANNEL_BANDWIDTH
+            cost += CHANNEL_BANDWIDTH * topology.hops[parent, child]
+    return cost + OVERLOAD_PENALTY * np.maximum(load - available, 0).sum()
+
+
+def _start_tree(nodes, free, old_parent, hops):
+    # Parents of the free nodes: a free node takes its old parent once that parent is placed,
+    # and otherwise the closest placed node
+    placed = [node for node, is_free in zip(nodes, free) if not is_free]
+    waiting = [node for node, is_free in zip(nodes, free) if is_free]
+    parents = {}
+    while waiting:
+        ready = [node for node in waiting if old_parent.get(node) in placed]
+        if not ready:
+            node = waiting[0]
+            old_parent[node] = placed[int(np.argmin(hops[placed, node]))]
+            ready = [node]
+        for node in ready:
+            parents[node] = old_parent[node]
+            placed.append(node)
+            waiting.remove(node)
+    return parents
+
+
+def _depth(parents, node):
+    depth = 0
+    while node in parents:
+        node = parents[node]
+        depth += 1
+    return depth
+
+
+def _tree_values(trees, pair_channel, pair_parent, pair_child, paths, available):
+    # Model values of the trees: x from the parents, levels from depth below the fixed part, overload as slack
+    x = np.array([trees[index][2].get(child) == parent
+                  for index, parent, child in zip(pair_channel, pair_parent, pair_child)], dtype=np.float64)
+    levels = [_depth(parents, node) for index, (nodes, free, parents) in sorted(trees.iteritems())
+              for node in nodes[free]]
+    slack = np.maximum(paths.T.dot(x) * CHANNEL_BANDWIDTH - available, 0)
+    return np.concatenate([x, levels, slack])
+
+
+class _SearchBudget(object):
+    # Per-round stop condition of the searches, every check counts as one step
+    def __init__(self, deadline=None, steps=None):
+        self.deadline = deadline
+        self.steps = steps
+        self.used = 0
+
+    def expired(self):
+        self.used += 1
+        return ((self.steps is not None and self.used > self.steps) or
+                (self.deadline is not None and time.time() >= self.deadline))
+
+
+def _site_values(is_open, qoe_cost, demand, demand_channel, capacity):
+    # Model values of a set of open sites: each demand at its closest open site, overload as slack
+    nearest = np.argmin(np.where(is_open[demand_channel], qoe_cost, np.inf), axis=1)
+    z = np.zeros(qoe_cost.shape)
+    z[np.arange(len(demand)), nearest] = 1
+    load = np.bincount(nearest, weights=demand, minlength=len(capacity))
+    return np.concatenate([is_open.ravel(), z.ravel(), np.maximum(load - capacity, 0)])
+
+
+def _site_objective(is_open, open_cost, qoe_cost, demand, demand_channel, capacity):
+    cost = np.where(is_open[demand_channel], qoe_cost, np.inf)
+    nearest = np.argmin(cost, axis=1)
+    load = np.bincount(nearest, weights=demand, minlength=len(capacity))
+    return (cost[np.arange(len(nearest)), nearest].sum() + open_cost[is_open].sum() +
+            OVERLOAD_PENALTY * np.maximum(load - capacity, 0).sum())
+
+
+def _search_sites(is_site, open_cost, qoe_cost, demand, demand_channel, capacity, delta, budget):
+    # Greedy: open the new site that lowers the objective most, at most delta new sites per channel. Then local
+    # search: drop a new site or move it to another server while that helps. Returns the best sites so far once
+    # the deadline passes.
+    is_open = is_site.copy()
+
+    def objective():
+        return _site_objective(is_open, open_cost, qoe_cost, demand, demand_channel, capacity)
+
+    best = objective()
+    opened = np.zeros(len(delta), dtype=np.int64)
+    improved = True
+    while improved and not budget.expired():
+        improved = False
+        # Viewer cost a site would save if capacity were no issue ranks the candidates
+        current = np.where(is_open[demand_channel], qoe_cost, np.inf).min(axis=1)
+        saving = np.zeros(is_open.shape)
+        np.add.at(saving, demand_channel, np.maximum(current[:, None] - qoe_cost, 0))
+        saving -= open_cost
+        saving[is_open | (opened >= delta)[:, None]] = -np.inf
+        for channel, server in zip(*np.unravel_index(np.argsort(-saving, axis=None), saving.shape)):
+            if saving[channel, server] <= 0 or budget.expired():
+                break
+            is_open[channel, server] = True
+            value = objective()
+            if value < best:
+                best, improved = value, True
+                opened[channel] += 1
+                break
+            is_open[channel, server] = False
+
+    improved = True
+    while improved and not budget.expired():
+        improved = False
+        for channel, server in zip(*np.nonzero(is_open & ~is_site)):
+            is_open[channel, server] = False
+            value = objective()
+            move = -1 if value < best else None
+            best = min(best, value)
+            for other in np.nonzero(~is_open[channel])[0]:
+                if budget.expired():
+                    break
+                if other == server:
+                    continue
+                is_open[channel, other] = True
+                value = objective()
+                if value < best:
+                    best, move = value, other
+                is_open[channel, other] = False
+            if move is None:
+                is_open[channel, server] = True
+            else:
+                if move >= 0:
+                    is_open[channel, move] = True
+                improved = True
+    return is_open
+
+
+def _search_trees(topology, trees, available, budget):
+    # Local search: move a free terminal under another terminal of its tree, outside its own subtree,
+    # while that lowers stream hops plus overload. Parents are updated in place.
+    hops = topology.hops
+    load = np.zeros(len(available))
+    for nodes, free, parents in trees.itervalues():
+        for child, parent in parents.iteritems():
+            load[topology.get_edges_on_path(parent, child)] += CHANNEL_BANDWIDTH
+
+    def attach_cost(parent, child):
+        edges = topology.get_edges_on_path(parent, child)
+        overload = (np.maximum(load[edges] + CHANNEL_BANDWIDTH - available[edges], 0) -
+                    np.maximum(load[edges] - available[edges], 0)).sum()
+        return CHANNEL_BANDWIDTH * hops[parent, child] + OVERLOAD_PENALTY * overload
+
+    improved = True
+    while improved and not budget.expired():
+        improved = False
+        for index in sorted(trees):
+            nodes, free, parents = trees[index]
+            for child in nodes[free].tolist():
+                if budget.expired():
+                    return
+                parent = parents[child]
+                load[topology.get_edges_on_path(parent, child)] -= CHANNEL_BANDWIDTH
+                best, best_parent = attach_cost(parent, child), parent
+                for candidate in nodes.tolist():
+                    if candidate in (child, parent) or _descends(parents, candidate, child):
+                        continue
+                    cost = attach_cost(candidate, child)
+                    if cost < best:
+                        best, best_parent = cost, candidate
+                parents[child] = best_parent
+                load[topology.get_edges_on_path(best_parent, child)] += CHANNEL_BANDWIDTH
+                improved = improved or best_parent != parent
+
+
+def _descends(parents, node, ancestor):
+    while node in parents:
+        node = parents[node]
+        if node == ancestor:
+            return True
+    return False
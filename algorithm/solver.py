@@ -0,0 +1,314 @@
+from collections import namedtuple
+from distutils.spawn import find_executable
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+from scipy import sparse
+
+# x: variable values, objective: cost of x, bound: best proven lower bound on the objective
+Solution = namedtuple('Solution', ['x', 'objective', 'bound'])
+
+
+class MILP(object):
+    """min cost.x  s.t.  row_lower <= A x <= row_upper,  lower <= x <= upper,  x integer where flagged.
+
+    Variables and rows are added in vectorized blocks, A is kept in COO pieces until it is solved.
+    """
+    def __init__(self):
+        self.number_of_variables = 0
+        self.number_of_rows = 0
+        self._variables = []
+        self._entries = []
+        self._row_bounds = []
+
+    def add_variables(self, cost, lower=0, upper=np.inf, integer=False):
+        # Returns the indices of the new variables
+        cost = np.asarray(cost, dtype=np.float64)
+        number = len(cost)
+        self._variables.append((cost, np.zeros(number) + lower, np.zeros(number) + upper,
+                                np.zeros(number, dtype=bool) | integer))
+        first = self.number_of_variables
+        self.number_of_variables += number
+        return np.arange(first, first + number)
+
+    def add_rows(self, number, rows, cols, vals, lower=-np.inf, upper=np.inf):
+        # rows count from 0 within the block, returns the indices of the new rows
+        first = self.number_of_rows
+        self._entries.append((np.asarray(rows, dtype=np.int64) + first, np.asarray(cols, dtype=np.int64),
+                              np.zeros(len(rows)) + vals))
+        self._row_bounds.append((np.zeros(number) + lower, np.zeros(number) + upper))
+        self.number_of_rows += number
+        return np.arange(first, first + number)
+
+    def arrays(self):
+        # (cost, lower, upper, integer, A as CSR, row_lower, row_upper)
+        cost, lower, upper, integer = [np.concatenate([block[i] for block in self._variables]) if self._variables
+                                       else np.zeros(0) for i in xrange(4)]
+        integer = integer.astype(bool)
+        if self._entries:
+            rows, cols, vals = [np.concatenate([block[i] for block in self._entries]) for i in xrange(3)]
+            row_lower, row_upper = [np.concatenate([block[i] for block in self._row_bounds]) for i in xrange(2)]
+        else:
+            rows = cols = np.zeros(0, dtype=np.int64)
+            vals = row_lower = row_upper = np.zeros(0)
+        matrix = sparse.coo_matrix((vals, (rows, cols)), shape=(self.number_of_rows, self.number_of_variables))
+        return cost, lower, upper, integer, matrix.tocsr(), row_lower, row_upper
+
+    def objective(self, x):
+        return np.concatenate([block[0] for block in self._variables]).dot(x)
+
+    def is_feasible(self, x, tolerance=1e-6):
+        cost, lower, upper, integer, matrix, row_lower, row_upper = self.arrays()
+        activity = matrix.dot(x)
+        return bool((x >= lower - tolerance).all() and (x <= upper + tolerance).all() and
+                    (np.abs(x[integer] - np.round(x[integer])) <= tolerance).all() and
+                    (activity >= row_lower - tolerance).all() and (activity <= row_upper + tolerance).all())
+
+    def solve(self, backend='highs', start=None, time_limit=None, threads=1):
+        # Returns a Solution, or None when the backend found no feasible point.
+        # start is a full assignment from the previous round, every backend reads it as a MIP start.
+        check_backend(backend)
+        return BACKENDS[backend](self, start, time_limit, threads)
+
+
+def solve_highs(model, start=None, time_limit=None, threads=1):
+    # The highs command line solver on the model as MPS, the start is read as a MIP start
+    binary = check_backend('highs')
+    directory = tempfile.mkdtemp(prefix='milp')
+    try:
+        model_path, options_path, solution_path, start_path = [
+            os.path.join(directory, name) for name in ('model.mps', 'options.txt', 'solution.txt', 'start.txt')]
+        write_mps(model, model_path)
+        with open(options_path, 'w') as out:
+            out.write('threads = {}\n'.format(threads))
+            if time_limit is not None:
+                out.write('time_limit = {!r}\n'.format(float(time_limit)))
+        command = [binary, '--model_file', model_path, '--options_file', options_path,
+                   '--solution_file', solution_path]
+        if start is not None:
+            with open(start_path, 'w') as out:
+                out.write('Model status\nUnknown\n\n# Primal solution values\nFeasible\n')
+                out.write('Objective {!r}\n# Columns {}\n'.format(float(model.objective(start)), len(start)))
+                out.writelines('x{} {!r}\n'.format(i, float(value)) for i, value in enumerate(start))
+            command += ['--read_solution_file', start_path]
+        log = _run(command, directory)
+        x = _read_highs_solution(solution_path, model.number_of_variables)
+    finally:
+        shutil.rmtree(directory)
+    if x is None:
+        return None
+    bound = re.search(r'Dual bound\s+(\S+)', log)
+    return Solution(x, model.objective(x), float(bound.group(1)) if bound else -np.inf)
+
+
+def solve_cbc(model, start=None, time_limit=None, threads=1):
+    # The cbc command line solver on the model as MPS, the start is read as a MIP start
+    binary = check_backend('cbc')
+    directory = tempfile.mkdtemp(prefix='milp')
+    try:
+        model_path, solution_path, start_path = [
+            os.path.join(directory, name) for name in ('model.mps', 'solution.txt', 'start.txt')]
+        write_mps(model, model_path)
+        command = [binary, model_path, '-threads', str(threads)]
+        if time_limit is not None:
+            command += ['-sec', repr(float(time_limit))]
+        if start is not None:
+            with open(start_path, 'w') as out:
+                out.write('Feasible - objective value {!r}\n'.format(float(model.objective(start))))
+                out.writelines('{0} x{0} {1!r} 0\n'.format(i, float(value)) for i, value in enumerate(start))
+            command += ['-mips', start_path]
+        log = _run(command + ['-solve', '-solu', solution_path], directory)
+        with open(solution_path) as solution:
+            status = solution.readline()
+            # Only nonzero values are listed, infeasible ones marked with **
+            x = np.zeros(model.number_of_variables)
+            for line in solution:
+                fields = line.replace('**', '').split()
+                x[int(fields[0])] = float(fields[2])
+    finally:
+        shutil.rmtree(directory)
+    objective = re.search(r'objective value\s+(\S+)', status)
+    if 'nfeasible' in status or objective is None or float(objective.group(1)) >= 1e50:
+        return None
+    if status.startswith('Optimal'):
+        bound = model.objective(x)
+    else:
+        bound = re.search(r'Lower bound:\s+(\S+)', log)
+        bound = float(bound.group(1)) if bound else -np.inf
+    return Solution(x, model.objective(x), bound)
+
+
+def solve_cplex(model, start=None, time_limit=None, threads=1):
+    check_backend('cplex')
+    import cplex
+    cost, lower, upper, integer, matrix, row_lower, row_upper = model.arrays()
+    prob = cplex.Cplex()
+    prob.set_log_stream(None)
+    prob.set_results_stream(None)
+    prob.objective.set_sense(prob.objective.sense.minimize)
+    prob.variables.add(obj=cost.tolist(), lb=np.maximum(lower, -cplex.infinity).tolist(),
+                       ub=np.minimum(upper, cplex.infinity).tolist(),
+                       types=''.join('I' if flag else 'C' for flag in integer))
+
+    # Every row becomes one ranged constraint: E, L, G or R with range upper - lower
+    equal = row_lower == row_upper
+    senses = np.where(equal, 'E', np.where(np.isinf(row_lower), 'L', np.where(np.isinf(row_upper), 'G', 'R')))
+    rhs = np.where(np.isinf(row_lower), row_upper, row_lower)
+    ranges = np.where(senses == 'R', row_upper - row_lower, 0)
+    prob.linear_constraints.add(rhs=rhs.tolist(), senses=''.join(senses), range_values=ranges.tolist())
+    entries = matrix.tocoo()
+    if entries.nnz:
+        prob.linear_constraints.set_coefficients(zip(entries.row.tolist(), entries.col.tolist(), entries.data.tolist()))
+
+    prob.parameters.threads.set(threads)
+    if time_limit is not None:
+        prob.parameters.timelimit.set(time_limit)
+    if start is not None:
+        prob.MIP_starts.add(cplex.SparsePair(ind=range(model.number_of_variables), val=np.asarray(start).tolist()),
+                            prob.MIP_starts.effort_level.repair)
+    prob.solve()
+    if not prob.solution.is_primal_feasible():
+        return None
+    return Solution(np.array(prob.solution.get_values()), prob.solution.get_objective_value(),
+                    prob.solution.MIP.get_best_objective())
+
+
+def write_mps(model, path):
+    # Free MPS with columns x<i> and rows r<i>. Rows without bounds are left out, every column is written with
+    # its objective entry and explicit bounds so no solver falls back to its own integer defaults. Sections are
+    # built from arrays by _lines, nothing is formatted one element at a time.
+    cost, lower, upper, integer, matrix, row_lower, row_upper = model.arrays()
+    number_of_variables = model.number_of_variables
+    columns = np.arange(number_of_variables).astype(str)
+    row_names = np.arange(model.number_of_rows).astype(str)
+    bounded = ~(np.isinf(row_lower) & np.isinf(row_upper))
+    rows = np.nonzero(bounded)[0]
+    kinds = np.where(row_lower[rows] == row_upper[rows], 'E', np.where(np.isinf(row_lower[rows]), 'L', 'G'))
+    sections = ['NAME model\nROWS\n N obj\n', _lines(' ', kinds, ' r', row_names[rows])]
+
+    # Every column's objective entry, then its entries in bounded rows. Each run of integer columns sits between
+    # an INTORG and an INTEND marker.
+    sections.append('COLUMNS\n')
+    matrix = matrix.tocsc()
+    entry_columns = np.repeat(np.arange(number_of_variables), np.diff(matrix.indptr))
+    in_bounded = bounded[matrix.indices]
+    entry_columns, entry_rows = entry_columns[in_bounded], matrix.indices[in_bounded]
+    runs = np.nonzero(np.diff(np.concatenate([[False], integer]).astype(np.int8)))[0]
+    lines = _stack([_lines(np.where(integer[runs], " MARKER 'MARKER' 'INTORG'", " MARKER 'MARKER' 'INTEND'")),
+                    _lines(' x', columns, ' obj ', _numbers(cost)),
+                    _lines(' x', columns[entry_columns], ' r', row_names[entry_rows], ' ',
+                           _numbers(matrix.data[in_bounded]))])
+    order = np.lexsort((np.repeat([0, 1, 2], [len(runs), number_of_variables, len(entry_columns)]),
+                        np.concatenate([runs, np.arange(number_of_variables), entry_columns])))
+    sections.append(lines[order])
+    if number_of_variables and integer[-1]:
+        sections.append(" MARKER 'MARKER' 'INTEND'\n")
+
+    # G rows take their lower bound as right-hand side, a finite upper bound becomes the range above it
+    sections.append('RHS\n')
+    rhs = np.where(np.isinf(row_lower), row_upper, row_lower)
+    rows = np.nonzero(bounded & (rhs != 0))[0]
+    sections.append(_lines(' rhs r', row_names[rows], ' ', _numbers(rhs[rows])))
+    sections.append('RANGES\n')
+    rows = np.nonzero(bounded & np.isfinite(row_lower) & np.isfinite(row_upper) & (row_lower != row_upper))[0]
+    sections.append(_lines(' rng r', row_names[rows], ' ', _numbers(row_upper[rows] - row_lower[rows])))
+
+    # FX for fixed columns, otherwise MI or LO followed by PL or UP
+    sections.append('BOUNDS\n')
+    fixed = lower == upper
+    free_below, free_above = np.isinf(lower) & ~fixed, np.isinf(upper)
+    bounds = _stack([_lines(np.where(fixed, ' FX', np.where(free_below, ' MI', ' LO')), ' bnd x', columns,
+                            np.where(free_below, '', ' '), np.where(free_below, '', _numbers(lower))),
+                     _lines(np.where(free_above, ' PL', ' UP'), ' bnd x', columns,
+                            np.where(free_above, '', ' '), np.where(free_above, '', _numbers(upper)))])
+    # Row i of bounds is the first line of column i, row number_of_variables + i its second
+    order = np.stack([np.arange(number_of_variables), np.arange(number_of_variables) + number_of_variables], axis=1)
+    sections.append(bounds[order[np.stack([np.ones_like(fixed), ~fixed], axis=1)]])
+    sections.append('ENDATA\n')
+    with open(path, 'w') as out:
+        for section in sections:
+            if isinstance(section, str):
+                out.write(section)
+            else:
+                # Drop the padding _lines kept inside every line
+                text = section.ravel()
+                out.write(text[text != 0].tostring())
+
+
+def _numbers(values):
+    # Shortest round-trip text of every value, each distinct value is formatted once
+    values, inverse = np.unique(np.asarray(values, dtype=np.float64), return_inverse=True)
+    return values.astype(str)[inverse]
+
+
+def _lines(*parts):
+    # One newline-terminated line per element as a (lines x bytes) uint8 array: the parts, string arrays or
+    # constants, side by side with their NUL padding, which is dropped when the section is written
+    parts = np.broadcast_arrays(*[np.asarray(part, dtype=np.string_) for part in parts + ('\n',)])
+    return np.hstack([np.ascontiguousarray(part).view(np.uint8).reshape(len(part), part.dtype.itemsize)
+                      for part in parts])
+
+
+def _stack(blocks):
+    # _lines blocks one after another, padded to the widest
+    width = max(block.shape[1] for block in blocks)
+    return np.vstack([np.pad(block, ((0, 0), (0, width - block.shape[1])), 'constant') for block in blocks])
+
+
+def _read_highs_solution(path, number_of_variables):
+    # Primal values from a highs solution file, None unless they are feasible
+    with open(path) as solution:
+        lines = solution.read().split('\n')
+    section = lines.index('# Primal solution values')
+    if lines[section + 1] != 'Feasible':
+        return None
+    first = next(i for i in xrange(section, len(lines)) if lines[i].startswith('# Columns')) + 1
+    x = np.zeros(number_of_variables)
+    for line in lines[first:first + number_of_variables]:
+        name, value = line.split()
+        x[int(name[1:])] = float(value)
+    return x
+
+
+def _run(command, directory):
+    # Returns the solver's log, a failed run raises with its last lines. The solver runs in the scratch
+    # directory, so files it writes on its own (highs writes Highs.log) go away with it.
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=directory)
+    log = process.communicate()[0]
+    if process.returncode != 0:
+        raise RuntimeError("{} exited with {}:\n{}".format(command[0], process.returncode,
+                                                           '\n'.join(log.splitlines()[-10:])))
+    return log
+
+
+class SolverUnavailable(RuntimeError):
+    pass
+
+
+# Command line solver name => path found on PATH, looked up once per process
+_binaries = {}
+
+
+def check_backend(backend):
+    # Raises SolverUnavailable unless the backend can run here, returns the binary path for command line solvers
+    if backend not in BACKENDS:
+        raise SolverUnavailable("unknown MILP backend {!r}, choose from {}".format(backend, sorted(BACKENDS)))
+    if backend == 'cplex':
+        try:
+            import cplex
+        except ImportError:
+            raise SolverUnavailable("the cplex backend needs the CPLEX Python API (import cplex failed)")
+        return None
+    if backend not in _binaries:
+        _binaries[backend] = find_executable(backend)
+    binary = _binaries[backend]
+    if binary is None:
+        raise SolverUnavailable("the {0} backend runs the {0} binary, which is not on PATH".format(backend))
+    return binary
+
+
+# Backend name => solve function, command line solvers run as subprocesses and cplex is imported on first use
+BACKENDS = {'highs': solve_highs, 'cbc': solve_cbc, 'cplex': solve_cplex}
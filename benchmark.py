@@ -0,0 +1,119 @@
+#!/usr/bin/python
+import argparse
+import json
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from engine import simulate_events
+from main import simulate
+from synthetic import fat_tree, random_geometric, scaled_nsfnet, synthetic_trace
+from system import System
+from timing import PhaseTimer
+from topology import Topology
+from trace import Trace
+
+# Round loop phases in the order simulate() runs them
+PHASES = ['trace', 'channel_removal', 'user_removal', 'tree_shrink', 'channel_addition', 'compute',
+          'update_network_status']
+# Seconds from interpreter start to the end of the first round on topo/nsfnet.json with its routing cached
+COLD_START_TARGET = 0.2
+# Run in a fresh interpreter: prints whether networkx got imported on the way to the first round
+COLD_START_SCRIPT = """
+import json, sys
+from main import simulate
+from system import System
+from topology import Topology
+from trace import Trace
+with open(sys.argv[1]) as topo_file:
+    topology = Topology(json.load(topo_file))
+trace = Trace(sys.argv[2], verbose=False, locations=topology.locations)
+next(simulate(topology, trace, System(topology), verbose=False))
+print 'networkx' in sys.modules
+"""
+
+
+def make_topology(kind, size, seed=0):
+    if kind == 'fattree':
+        return fat_tree(size)
+    if kind == 'geometric':
+        return random_geometric(size, rng=random.Random(seed))
+    with open('topo/nsfnet.json') as base:
+        return scaled_nsfnet(size, json.load(base))
+
+
+def run_benchmark(topo_json, rounds, channels, viewers, flash_crowds=0, incremental=True, seed=0, workers=1,
+                  events=False):
+    # One timed run on a freshly generated trace: topology build time plus seconds per round of every phase.
+    # events runs the trace through the event engine instead of the round loop.
+    trace_dir = tempfile.mkdtemp()
+    try:
+        synthetic_trace(trace_dir + '/', topo_json, rounds=rounds, channels=channels, viewers=viewers,
+                        flash_crowds=flash_crowds, seed=seed)
+        start = time.time()
+        topology = Topology(topo_json, cache_dir=None)
+        topology_seconds = time.time() - start
+
+        timer = PhaseTimer()
+        trace = Trace(trace_dir + '/', rng=random.Random(seed), verbose=False, locations=topology.locations)
+        system = System(topology)
+        run = simulate_events if events else simulate
+        for _ in run(topology, trace, system, incremental=incremental, rng=random.Random(seed), verbose=False,
+                     timer=timer, workers=workers):
+            pass
+    finally:
+        shutil.rmtree(trace_dir)
+
+    result = {'nodes': topo_json['number_of_nodes'], 'edges': len(topo_json['edge_list']),
+              'topology': topology_seconds}
+    for phase in PHASES:
+        result[phase] = timer.seconds[phase] / max(trace.round_no, 1)
+    return result
+
+
+def cold_start(topology_path='topo/nsfnet.json', trace_dir='trace/', repeats=5):
+    # Best of `repeats` fresh processes, the first one also fills the routing cache and is not counted
+    command = [sys.executable, '-c', COLD_START_SCRIPT, topology_path, trace_dir]
+    subprocess.check_output(command)
+    best = float('inf')
+    for _ in xrange(repeats):
+        start = time.time()
+        networkx_loaded = subprocess.check_output(command).strip() == 'True'
+        best = min(best, time.time() - start)
+    return best, networkx_loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each round-loop phase as topology and trace size grow")
+    parser.add_argument('--topology', default='fattree', choices=['fattree', 'geometric', 'nsfnet'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[4, 8, 16],
+                        help="k for fattree, nodes for geometric, copies for nsfnet")
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--channels', type=int, default=300)
+    parser.add_argument('--viewers', type=int, default=8000, help="viewer requests per round")
+    parser.add_argument('--flash-crowds', type=int, default=0)
+    parser.add_argument('--full', action='store_true', help="recompute delivery trees instead of incremental")
+    parser.add_argument('--workers', type=int, default=1, help="processes for full delivery tree computation")
+    parser.add_argument('--events', action='store_true', help="dispatch events at their seq timestamps")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cold-start', action='store_true',
+                        help="time process start to first round on topo/nsfnet.json and trace/ instead")
+    args = parser.parse_args()
+
+    if args.cold_start:
+        seconds, networkx_loaded = cold_start()
+        print 'cold start {:.3f}s, target {:.3f}s, networkx imported: {}'.format(seconds, COLD_START_TARGET,
+                                                                               networkx_loaded)
+        sys.exit(0 if seconds <= COLD_START_TARGET and not networkx_loaded else 1)
+
+    columns = ['size', 'nodes', 'edges', 'topology'] + PHASES
+    print '\t'.join(columns)
+    for size in args.sizes:
+        result = run_benchmark(make_topology(args.topology, size, args.seed), args.rounds, args.channels,
+                               args.viewers, args.flash_crowds, not args.full, args.seed, args.workers,
+                               args.events)
+        result['size'] = size
+        print '\t'.join(str(result[column]) if isinstance(result[column], int) else '{:.4f}'.format(result[column])
+                        for column in columns)
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+import cPickle as pickle
+import itertools
+import json
+import os
+import random
+import sys
+import traceback
+from main import simulate
+from topology import Topology
+from trace import Trace
+from system import System
+
+
+class Checkpoint(object):
+    """Simulator state between two rounds: network state, System tables, trace cursor and TTLs, and RNGs.
+
+    The topology itself is static and not saved, a checkpoint is restored onto the same topology.
+    """
+    def __init__(self, topology, trace, system, rng=random):
+        self.round_no = trace.round_no
+        self.number_of_nodes = topology.number_of_nodes
+        # One pickle, so objects shared between trace and system stay shared after a restore
+        self.data = pickle.dumps((topology.state.snapshot(), trace, system, _rng_state(rng)),
+                                 pickle.HIGHEST_PROTOCOL)
+
+    def restore(self, topology, rng=random):
+        # Put the network state back into topology and return fresh (trace, system) at the saved round.
+        # rng, the simulation random source, is rewound to where it was.
+        if topology.number_of_nodes != self.number_of_nodes:
+            raise ValueError("checkpoint was taken on a topology with {} nodes".format(self.number_of_nodes))
+        state, trace, system, rng_state = pickle.loads(self.data)
+        topology.state.restore(state)
+        system.topology = topology
+        if rng_state is not None:
+            rng.setstate(rng_state)
+        return trace, system
+
+    def save(self, path):
+        with open(path, 'wb') as out:
+            pickle.dump(self, out, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as checkpoint_file:
+            return pickle.load(checkpoint_file)
+
+
+def _rng_state(rng):
+    return rng.getstate() if rng is not None else None
+
+
+def run_forked(function, *args):
+    # Run function(*args) in a forked child and return its result. The child starts from a copy-on-write
+    # image of this process, so a branch sees the current simulation state without copying or replaying it,
+    # and nothing it changes leaks back. An exception in the child is raised again here.
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Whatever happens, the child never returns into the caller's code
+        status = 1
+        try:
+            os.close(read_fd)
+            try:
+                result = (True, function(*args))
+                status = 0
+            except BaseException as error:
+                result = (False, error)
+            try:
+                data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            except BaseException:
+                # The result or the exception does not pickle, send back what went wrong as text
+                data = pickle.dumps((False, ForkedError("{!r} from the forked child:\n{}".format(
+                    result[1], traceback.format_exc()))), pickle.HIGHEST_PROTOCOL)
+                status = 1
+            with os.fdopen(write_fd, 'wb') as out:
+                out.write(data)
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as result_file:
+        data = result_file.read()
+    _, status = os.waitpid(pid, 0)
+    if not data:
+        raise ForkedError("forked child died with status {} before sending a result".format(status))
+    ok, result = pickle.loads(data)
+    if not ok:
+        raise result
+    return result
+
+
+class ForkedError(RuntimeError):
+    pass
+
+
+if __name__ == "__main__":
+    # Run the shared prefix once, then finish the trace incrementally and with full tree recomputation
+    prefix = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    with open('topo/nsfnet.json') as sample_topo:
+        topology = Topology(json.load(sample_topo))
+    trace = Trace('trace/', verbose=False)
+    system = System(topology)
+    for _ in itertools.islice(simulate(topology, trace, system, verbose=False), prefix):
+        pass
+    checkpoint = Checkpoint(topology, trace, system)
+    print "Checkpoint at round {}: {} bytes".format(checkpoint.round_no, len(checkpoint.data))
+
+    def finish(incremental):
+        return list(simulate(topology, trace, system, incremental=incremental, verbose=False))
+
+    for incremental in (True, False):
+        results = run_forked(finish, incremental)
+        print "incremental={}: {} more rounds, {} failed deliveries".format(
+            incremental, len(results), sum(failed_deliver for _, failed_deliver, _ in results))
+
+    # The same branch again in this process, from the saved state
+    trace, system = checkpoint.restore(topology)
+    print "restored incremental: {} failed deliveries".format(
+        sum(failed_deliver for _, failed_deliver, _ in finish(True)))
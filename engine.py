@@ -0,0 +1,151 @@
+#!/usr/bin/python
+import argparse
+import heapq
+import json
+import random
+from itertools import repeat
+from main import simulate_round
+from multicast import Multicast
+from system import System
+from timing import NULL_TIMER
+from topology import Topology
+from trace import Trace
+
+# Event kinds, the index of their list in a round's events
+CHANNEL_JOIN, CHANNEL_LEAVE, VIEWER_JOIN, VIEWER_LEAVE = range(4)
+# Item of a cancelled entry, and of one already handed out by pop_batch
+_CANCELLED = object()
+_DISPATCHED = object()
+
+
+class EventQueue(object):
+    """Timestamped channel and viewer events, dispatched one timestamp at a time.
+
+    The heap holds each distinct time once, the events at a time wait in a bucket in push order, so a batch of
+    simultaneous events costs one heap pop. Entries are [time, kind, item] lists. cancel() only marks an entry,
+    it is skipped at dispatch, and the buckets are rebuilt without cancelled entries once they make up half of
+    the queue. Cancelling an entry that was already dispatched or cancelled does nothing.
+    """
+    def __init__(self):
+        self._times = []
+        # time => [entry]
+        self._buckets = {}
+        self._size = 0
+        self._cancelled = 0
+
+    def __len__(self):
+        return self._size - self._cancelled
+
+    def push(self, time, kind, item):
+        # Returns the entry, the handle for cancel()
+        return self.push_many([(time, kind, item)])[0]
+
+    def push_many(self, events):
+        # (time, kind, item) triples, new times are heapified in one go when they outnumber the queued ones
+        buckets = self._buckets
+        entries, new_times = [], []
+        for time, kind, item in events:
+            entry = [time, kind, item]
+            entries.append(entry)
+            bucket = buckets.get(time)
+            if bucket is None:
+                bucket = buckets[time] = []
+                new_times.append(time)
+            bucket.append(entry)
+        self._size += len(entries)
+        if len(new_times) > len(self._times):
+            self._times += new_times
+            heapq.heapify(self._times)
+        else:
+            for time in new_times:
+                heapq.heappush(self._times, time)
+        return entries
+
+    def cancel(self, entry):
+        if entry[2] is _CANCELLED or entry[2] is _DISPATCHED:
+            return
+        entry[2] = _CANCELLED
+        self._cancelled += 1
+        if 2 * self._cancelled > self._size:
+            buckets = {}
+            for time, bucket in self._buckets.iteritems():
+                bucket = [live for live in bucket if live[2] is not _CANCELLED]
+                if bucket:
+                    buckets[time] = bucket
+            self._buckets = buckets
+            self._times = buckets.keys()
+            heapq.heapify(self._times)
+            self._size -= self._cancelled
+            self._cancelled = 0
+
+    def next_time(self):
+        # Earliest time with a live event, None when the queue is empty
+        while self._times:
+            time = self._times[0]
+            bucket = self._buckets[time]
+            if any(entry[2] is not _CANCELLED for entry in bucket):
+                return time
+            heapq.heappop(self._times)
+            del self._buckets[time]
+            self._size -= len(bucket)
+            self._cancelled -= len(bucket)
+        return None
+
+    def pop_batch(self):
+        # (time, [[joining channels], [leaving channels], [joining viewers], [leaving viewers]]) of every live
+        # event at the earliest time, in push order
+        time = self.next_time()
+        events = [[], [], [], []]
+        if time is None:
+            return time, events
+        heapq.heappop(self._times)
+        bucket = self._buckets.pop(time)
+        self._size -= len(bucket)
+        for entry in bucket:
+            if entry[2] is _CANCELLED:
+                self._cancelled -= 1
+            else:
+                events[entry[1]].append(entry[2])
+                entry[2] = _DISPATCHED
+        return time, events
+
+
+def simulate_events(topology, trace, system, algorithm=Multicast, incremental=True, rng=random, verbose=True,
+                    timer=NULL_TIMER, workers=1, admission='greedy'):
+    # Event-driven counterpart of main.simulate: each join and leave is dispatched at its seq timestamp and every
+    # timestamp runs as its own step, so capacity taken by earlier events is gone before later ones are admitted.
+    # Yields (time, failed access, failed deliveries, new trees) per timestamp. A trace whose records all carry
+    # the round number as seq gives one step per round, the same results as main.simulate.
+    queue = EventQueue()
+    while True:
+        with timer.phase('trace'):
+            events = trace.next_round()
+            if events is None:
+                return
+            for kind, (items, times) in enumerate(zip(events, trace.event_times)):
+                queue.push_many(zip(times, repeat(kind), items))
+        # Drain the round before the next one is read, the trace forgets its leaving viewers and channels then
+        while queue:
+            time, batch = queue.pop_batch()
+            failed_access, admitted_edges, failed_channels = simulate_round(
+                topology, trace, system, batch, algorithm, incremental, rng, verbose, timer, workers, admission)
+            yield time, failed_access, len(failed_channels), len(admitted_edges) + len(failed_channels)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a trace event by event at its seq timestamps")
+    parser.add_argument('--topology', default='topo/nsfnet.json')
+    parser.add_argument('--trace', default='trace/', help="directory of round files or a compiled trace")
+    parser.add_argument('--full', action='store_true', help="recompute delivery trees instead of incremental")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.topology) as topo_file:
+        topology = Topology(json.load(topo_file))
+    rng = random if args.seed is None else random.Random(args.seed)
+    trace = Trace(args.trace, rng=rng, verbose=False, locations=topology.locations)
+    system = System(topology)
+    for time, failed_access, failed_deliver, new_trees in simulate_events(topology, trace, system,
+                                                                          incremental=not args.full, rng=rng,
+                                                                          verbose=False):
+        print time, failed_access, failed_deliver, new_trees
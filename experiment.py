@@ -0,0 +1,100 @@
+#!/usr/bin/python
+import argparse
+import csv
+import functools
+import itertools
+import json
+import multiprocessing
+import random
+import sys
+from algorithm.livejack import LiveJack
+from algorithm.solver import SolverUnavailable, check_backend
+from main import simulate
+from multicast import Multicast
+from system import System
+from topology import Topology
+from trace import Trace
+
+# Per-round search steps of livejack-heuristic: a step count, unlike seconds, cuts the search at the same point on
+# every machine, so cells stay reproducible under any load
+HEURISTIC_STEPS = 20000
+# Algorithm name => class with the Multicast(topology, trace, system, events).compute(incremental) interface
+ALGORITHMS = {'multicast': Multicast, 'livejack': LiveJack,
+              'livejack-heuristic': functools.partial(LiveJack, method='heuristic', steps=HEURISTIC_STEPS)}
+# Algorithm name => MILP backend it solves with, checked before any cell runs
+SOLVER_BACKENDS = {'livejack': 'highs'}
+
+RESULT_FIELDS = ['topology', 'trace', 'algorithm', 'incremental', 'seed',
+                 'round', 'failed_access', 'failed_deliver', 'new_trees']
+
+
+def make_grid(topologies, traces, algorithms, incrementals, seeds):
+    return [{'topology': topology, 'trace': trace, 'algorithm': algorithm, 'incremental': incremental, 'seed': seed}
+            for topology, trace, algorithm, incremental, seed
+            in itertools.product(topologies, traces, algorithms, incrementals, seeds)]
+
+
+def run_cell(cell):
+    # Every random draw of a cell comes from its own seed: one stream for trace churn, one for the simulation
+    seeds = random.Random(cell['seed'])
+    trace_rng = random.Random(seeds.getrandbits(64))
+    simulation_rng = random.Random(seeds.getrandbits(64))
+
+    with open(cell['topology']) as topo_file:
+        topology = Topology(json.load(topo_file))
+    trace = Trace(cell['trace'], rng=trace_rng, verbose=False, locations=topology.locations)
+    system = System(topology)
+
+    rows = []
+    results = simulate(topology, trace, system, algorithm=ALGORITHMS[cell['algorithm']],
+                       incremental=cell['incremental'], rng=simulation_rng, verbose=False)
+    for round_no, (failed_access, failed_deliver, new_trees) in enumerate(results):
+        row = dict(cell)
+        row.update({'round': round_no, 'failed_access': int(failed_access),
+                    'failed_deliver': failed_deliver, 'new_trees': new_trees})
+        rows.append(row)
+    return rows
+
+
+def run_grid(cells, processes=None):
+    # Cells run in a process pool, rows come back in grid order whatever order the workers finish in
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(run_cell, cells, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return [row for rows in results for row in rows]
+
+
+def write_table(rows, out):
+    writer = csv.DictWriter(out, RESULT_FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run every (topology, trace, algorithm, incremental, seed) cell")
+    parser.add_argument('--topology', nargs='+', default=['topo/nsfnet.json'])
+    parser.add_argument('--trace', nargs='+', default=['trace/'])
+    parser.add_argument('--algorithm', nargs='+', default=['multicast'], choices=sorted(ALGORITHMS))
+    parser.add_argument('--incremental', nargs='+', default=['true'], choices=['true', 'false'])
+    parser.add_argument('--seed', nargs='+', type=int, default=[0])
+    parser.add_argument('--processes', type=int, default=None, help="worker processes, defaults to all cores")
+    parser.add_argument('--output', default=None, help="CSV file, defaults to stdout")
+    args = parser.parse_args()
+    for algorithm in args.algorithm:
+        if algorithm in SOLVER_BACKENDS:
+            try:
+                check_backend(SOLVER_BACKENDS[algorithm])
+            except SolverUnavailable as error:
+                parser.error("{}: {}".format(algorithm, error))
+
+    cells = make_grid(args.topology, args.trace, args.algorithm,
+                      [value == 'true' for value in args.incremental], args.seed)
+    rows = run_grid(cells, args.processes)
+    if args.output is None:
+        write_table(rows, sys.stdout)
+    else:
+        with open(args.output, 'wb') as out:
+            write_table(rows, out)
@@ -1,170 +1,191 @@
 #!/usr/bin/python
 import json
+import sys
 from multicast import Multicast
 from system import System
 from topology import Topology
-from random import shuffle
+import random
 from collections import defaultdict
 from trace import Trace
+from timing import NULL_TIMER
+from metrics import RoundMetrics
+import numpy as np
+from scipy import sparse
 
 
 def remove_channel(channel_to_remove, topology, system):
+    batch = topology.path_batch()
     # Remove channel traffic from delivery tree
-    for target, source_channel in system.delivery_tree.iteritems():
-        for source, channel in source_channel.iteritems():
-            if channel_to_remove in channel:
-                topology.topo.node[source]['qoe'][target] -= 1
-                links = topology.get_links_on_path(source, target)
-                for u, v in links:
-                    # TODO: set capacity value
-                    topology.topo.edge[u][v]['capacity'] += 100
-                    topology.topo.edge[u][v]['cost'] -= 100
+    for source, target in system.get_tree_edges(channel_to_remove):
+        batch.add_qoe(source, target, -1)
+        # TODO: set capacity value
+        batch.add(source, target, capacity=100, cost=-100)
 
     # Remove access traffic of that channel
-    for node_id in xrange(topology.topo.number_of_nodes()):
-        viewer_number = system.viewers[node_id][channel_to_remove]
-        recalculate_access_traffic(channel_to_remove, node_id, system, topology, viewer_number)
+    for node_id in system.access_point.positions(channel_to_remove):
+        viewer_number = system.viewers[node_id, channel_to_remove]
+        recalculate_access_traffic(channel_to_remove, node_id, system, topology, viewer_number, batch)
+    batch.commit()
 
     # Delete that channel from system
-    del system.channels[channel_to_remove]
-    for node_stat in system.access_point:
-        del node_stat[channel_to_remove]
-    for node_stat in system.viewers:
-        del node_stat[channel_to_remove]
-    for t in system.delivery_tree:
-        for s in system.delivery_tree[t]:
-            if channel_to_remove in system.delivery_tree[t][s]:
-                system.delivery_tree[t][s].remove(channel_to_remove)
-
-
-def recalculate_access_traffic(channel, node_id, system, topology, viewer_number):
-    for server, probability in system.access_point[node_id][channel].iteritems():
+    system.remove_channel(channel_to_remove)
+
+
+def recalculate_access_traffic(channel, node_id, system, topology, viewer_number, batch=None):
+    commit = batch is None
+    if commit:
+        batch = topology.path_batch()
+    for server, probability in system.access_point.get(node_id, channel).iteritems():
         # TODO: set new qoe value
-        topology.topo.node[server]['qoe'][node_id] += int(1 * viewer_number * probability)
-        links = topology.get_links_on_path(node_id, server)
-        for u, v in links:
-            # TODO: set capacity value
-            # topology.topo.edge[u][v]['capacity'] += int(100 * viewer_number * probability)
-            topology.topo.edge[u][v]['cost'] -= int(100 * viewer_number * probability)
+        batch.add_qoe(server, node_id, int(1 * viewer_number * probability))
+        # TODO: set capacity value
+        # batch.add(node_id, server, capacity=int(100 * viewer_number * probability))
+        batch.add(node_id, server, cost=-int(100 * viewer_number * probability))
+    if commit:
+        batch.commit()
 
 
 def remove_users(leaving_users, topology, system):
+    batch = topology.path_batch()
     for position, access_numbers in enumerate(leaving_users):
         for access_point, viewer_number in access_numbers.iteritems():
             # TODO: set new qoe value
-            topology.topo.node[access_point]['qoe'][position] += viewer_number
-            links = topology.get_links_on_path(position, access_point)
-            for u, v in links:
-                # TODO: set capacity value
-                topology.topo.edge[u][v]['cost'] -= viewer_number
+            batch.add_qoe(access_point, position, viewer_number)
+            # TODO: set capacity value
+            batch.add(position, access_point, cost=-viewer_number)
+    batch.commit()
 
 
-def can_be_removed(server, channel, server_access_numbers, delivery_tree):
-    if server_access_numbers[server][channel] != 0:
+def can_be_removed(server, channel, server_access_numbers, system):
+    if server_access_numbers[server, channel] != 0:
         return False
-    else:
-        for target in delivery_tree.iterkeys():
-            if server in system.delivery_tree[target] and channel in system.delivery_tree[target][server]:
-                # The server is delivering content to other servers
-                return False
-        return True
+    # The server is delivering content to other servers
+    return system.get_children_number(channel, server) == 0
 
 
 def shrink_delivery_tree(server_access_numbers, leaving_channels, topology, system):
-    for server in server_access_numbers.iterkeys():
-        for channel in server_access_numbers[server].iterkeys():
-            if channel in leaving_channels:
-                continue
-            remove_server_from_delivery_tree(channel, server, server_access_numbers, system, topology)
-
-
-def remove_server_from_delivery_tree(channel, server, server_access_numbers, system, topology):
-    if can_be_removed(server, channel, server_access_numbers, system.delivery_tree):
-        for source in system.delivery_tree[server].iterkeys():
-            if channel in system.delivery_tree[server][source]:
-                system.delivery_tree[server][source].remove(channel)
-                topology.topo.node[source]['qoe'][server] -= 1
-                links = topology.get_links_on_path(source, server)
-                for u, v in links:
-                    # TODO: set capacity value
-                    topology.topo.edge[u][v]['capacity'] += 100
-                    topology.topo.edge[u][v]['cost'] -= 100
-                remove_server_from_delivery_tree(channel, source, server_access_numbers, system, topology)
+    # Start from the zero-viewer leaves among the pairs touched since the last shrink, then walk up: a parent
+    # joins the worklist once its last child is pruned
+    touched, system.touched = system.touched, set()
+    worklist = [(server, channel) for server, channel in touched
+                if channel not in leaving_channels and system.access_point.has_server(server, channel) and
+                can_be_removed(server, channel, server_access_numbers, system)]
+    released = []
+    while worklist:
+        server, channel = worklist.pop()
+        for source in system.get_tree_parents(channel, server):
+            system.remove_tree_edge(channel, source, server)
+            released.append((source, server))
+            if can_be_removed(source, channel, server_access_numbers, system):
+                worklist.append((source, channel))
         if server in system.channels[channel]['sites']:
             system.channels[channel]['sites'].remove(server)
 
+    # Release the traffic and QoE of every pruned edge in one update
+    batch = topology.path_batch()
+    for source, server in released:
+        # TODO: set capacity value
+        batch.add(source, server, capacity=100, cost=-100)
+        batch.add_qoe(source, server, -1)
+    batch.commit()
+
+
+def admit_channels(topology, system, channels, new_delivery_tree, policy='greedy'):
+    # All-or-nothing admission of new delivery trees against residual link capacity. Each channel's
+    # aggregate per-link demand is computed once, then channels are admitted in one pass:
+    # 'greedy' in the given order, 'knapsack' by viewers per unit of capacity used, given order on ties.
+    # Returns (admitted channels in admission order, {channel -> [(source, target)]} of their edges).
+    if not channels:
+        # Most event-driven steps bring no new tree, skip building the demand matrices for them
+        return [], {}
+    edges = defaultdict(list)
+    for target, source_channel in new_delivery_tree.iteritems():
+        for source, channel_arr in source_channel.iteritems():
+            for channel in channel_arr:
+                edges[channel].append((source, target))
+
+    rows, pairs = [], []
+    for row, channel in enumerate(channels):
+        for source, target in edges[channel]:
+            rows.append(row)
+            pairs.append(topology.pair_id(source, target))
+    # demand[row][link]: bandwidth one channel's new tree needs on each link
+    # TODO: set capacity value
+    trees = sparse.csr_matrix((np.full(len(rows), 100, dtype=np.int64), (rows, pairs)),
+                              shape=(len(channels), topology.incidence.shape[0]))
+    demand = trees.dot(topology.incidence).tocsr()
+
+    order = np.arange(len(channels))
+    if policy == 'knapsack':
+        capacity_share = demand.dot(1.0 / np.maximum(topology.state.capacity, 1))
+        viewers = np.array([system.viewers[:, channel].sum() for channel in channels], dtype=np.float64)
+        order = np.argsort(-viewers / (capacity_share + 1e-9), kind='mergesort')
+
+    residual = topology.state.capacity.copy()
+    admitted = []
+    for row in order:
+        links = demand.indices[demand.indptr[row]:demand.indptr[row + 1]]
+        needed = demand.data[demand.indptr[row]:demand.indptr[row + 1]]
+        if (residual[links] - needed < 0).any():
+            continue
+        residual[links] -= needed
+        admitted.append(channels[row])
+    return admitted, edges
+
 
-def update_network_status(topology, trace, system, round_no, channels_with_new_delivery_tree, new_delivery_tree, incremental=True):
+def update_network_status(topology, trace, system, events, channels_with_new_delivery_tree, new_delivery_tree, incremental=True, rng=random,
+                          admission='greedy'):
     # Update number of viewers in the system
-    for new_viewer_id in trace.events[round_no][2]:
+    new_viewer_numbers = defaultdict(int)
+    for new_viewer_id in events[2]:
         position, channel, access_point = trace.viewers[new_viewer_id]
-        system.viewers[position][channel] += 1
+        new_viewer_numbers[(position, channel)] += 1
+    for (position, channel), viewer_number in new_viewer_numbers.iteritems():
+        system.add_viewers(position, channel, viewer_number)
 
     # Restore traffic of expired delivery tree
     updated_channel = set()
+    batch = topology.path_batch()
     for channel in channels_with_new_delivery_tree:
-        for u in system.delivery_tree.iterkeys():
-            for v in system.delivery_tree[u].iterkeys():
-                if channel in system.delivery_tree[u][v]:
-                    if not incremental:
-                        # We don't need to remove old traffic from delivery tree
-                        links = topology.get_links_on_path(u, v)
-                        for x, y in links:
-                            topology.topo.edge[x][y]['capacity'] += 100
-                            topology.topo.edge[x][y]['cost'] -= 1
-                        system.delivery_tree[u][v].remove(channel)
-                    updated_channel.add(channel)
+        if not system.get_tree_edges(channel):
+            continue
+        updated_channel.add(channel)
+        if not incremental:
+            # We don't need to remove old traffic from delivery tree
+            for source, target in system.remove_tree(channel):
+                batch.add(target, source, capacity=100, cost=-1)
+    batch.commit()
 
 
     failed_access = 0
-    failed_channels = set()
     channels = list(channels_with_new_delivery_tree)
-    shuffle(channels)  # Shuffle the order of channels for random choice
-
-    for channel in channels:
-        # Try to add channel delivery traffic into network
-        for target, source_channel in new_delivery_tree.iteritems():
-            for source, channel_arr in source_channel.iteritems():
-                if channel not in channel_arr or channel in failed_channels:
-                    continue
-                links = topology.get_links_on_path(source, target)
-                for u, v in links:
-                    # TODO: set capacity value
-                    if topology.topo.edge[u][v]['capacity'] - 100 < 0:
-                        # If capacity doesn't allow, mark the channel as delivery failure
-                        failed_channels.add(channel)
-                        break
-
-        # Update channel delivery traffic if capacity allows otherwise update access failure users
-        if channel not in failed_channels:
-            for target, source_channel in new_delivery_tree.iteritems():
-                for source, channel_arr in source_channel.iteritems():
-                    if channel in channel_arr:
-                        # TODO: set qoe value
-                        if 'qoe' in topology.topo.node[source]:
-                            topology.topo.node[source]['qoe'][target] += 1
-                        links = topology.get_links_on_path(source, target)
-                        for u, v in links:
-                            # TODO: set capacity and cost value
-                            topology.topo.edge[u][v]['capacity'] -= 100
-                            topology.topo.edge[u][v]['cost'] += 100
-                        if channel not in system.delivery_tree[target][source]:
-                            system.delivery_tree[target][source].append(channel)
+    rng.shuffle(channels)  # Shuffle the order of channels for random choice
+
+    # Add the delivery traffic of every channel whose whole tree fits, the others fail delivery
+    admitted, edges = admit_channels(topology, system, channels, new_delivery_tree, admission)
+    failed_channels = set(channels) - set(admitted)
+    for channel in admitted:
+        for source, target in edges[channel]:
+            # TODO: set qoe value
+            if topology.state.has_qoe[source]:
+                batch.add_qoe(source, target, 1)
+            # TODO: set capacity and cost value
+            batch.add(source, target, capacity=-100, cost=100)
+            system.add_tree_edge(channel, source, target)
+    batch.commit()
 
     # TODO: try to define failed access partially
     updated_and_failed_channel = failed_channels & updated_channel
-    for pos, channel_serve in enumerate(system.access_point):
-        for channel, server_probability in channel_serve.iteritems():
-            if channel not in updated_and_failed_channel:
-                continue
-            viewer_number = system.viewers[pos][channel]
+    for channel in updated_and_failed_channel:
+        for pos, server_probability in system.access_point.items(channel):
+            viewer_number = system.viewers[pos, channel]
             failed_access += viewer_number
             for server, probability in server_probability.iteritems():
-                topology.topo.node[server]['server'] += int(viewer_number * probability)
-                topology.topo.node[server]['qoe'][pos] -= int(viewer_number * probability)
+                topology.state.server[server] += int(viewer_number * probability)
+                batch.add_qoe(server, pos, -int(viewer_number * probability))
 
-    new_viewers = [defaultdict(int) for _ in xrange(topology.topo.number_of_nodes())]
-    for viewer_id in trace.events[round_no][2]:
+    new_viewers = [defaultdict(int) for _ in xrange(topology.number_of_nodes)]
+    for viewer_id in events[2]:
         position, channel, access_point = trace.viewers[viewer_id]
         # Get new viewer whose channel can be successfully delivered
         if channel in failed_channels:
@@ -177,18 +198,87 @@ def update_network_status(topology, trace, system, round_no, channels_with_new_d
         for server, viewer_number in ap_number.iteritems():
             # TODO: set qoe and server value
             # Try to fill server capacity with user requests
-            if topology.topo.node[server]['server'] - viewer_number < 0:
-                failed_access += viewer_number - topology.topo.node[server]['server']
-                topology.topo.node[server]['qoe'][pos] += topology.topo.node[server]['server']
-                topology.topo.node[server]['server'] = 0
+            if topology.state.server[server] - viewer_number < 0:
+                failed_access += viewer_number - topology.state.server[server]
+                batch.add_qoe(server, pos, topology.state.server[server])
+                topology.state.server[server] = 0
             else:
-                topology.topo.node[server]['qoe'][pos] += viewer_number
-                topology.topo.node[server]['server'] -= viewer_number
+                batch.add_qoe(server, pos, viewer_number)
+                topology.state.server[server] -= viewer_number
+    batch.commit()
+
+    # print topology.state.capacity
+
+    # The edges each admitted channel added to its tree, the whole new tree when recomputed in full
+    admitted_edges = dict((channel, edges[channel]) for channel in admitted)
+    return failed_access, admitted_edges, failed_channels
+
+
+def simulate(topology, trace, system, algorithm=Multicast, incremental=True, rng=random, verbose=True, timer=NULL_TIMER,
+             workers=1, admission='greedy'):
+    # Run the round loop over the whole trace, yielding (failed access, failed deliveries, new trees) per round.
+    # workers > 1 spreads full delivery tree computation over that many processes, admission is the
+    # admit_channels policy for new delivery trees.
+    while True:
+        with timer.phase('trace'):
+            events = trace.next_round()
+        if events is None:
+            return
+        failed_access, admitted_edges, failed_channels = simulate_round(
+            topology, trace, system, events, algorithm, incremental, rng, verbose, timer, workers, admission)
+        yield failed_access, len(failed_channels), len(admitted_edges) + len(failed_channels)
+
+
+def simulate_round(topology, trace, system, events, algorithm=Multicast, incremental=True, rng=random, verbose=True,
+                   timer=NULL_TIMER, workers=1, admission='greedy'):
+    # One round on events already read from trace, returns (failed access, {channel -> [(source, target)]}
+    # of the edges added by every admitted new delivery tree, set of channels whose new tree failed admission)
+
+    # Remove leaving channels
+    with timer.phase('channel_removal'):
+        for leaving_channel in events[1]:
+            remove_channel(leaving_channel, topology, system)
+    if verbose:
+        print "Leaving channels removed!"
+
+    # Remove leaving users
+    with timer.phase('user_removal'):
+        leaving_users = [defaultdict(int) for _ in xrange(topology.number_of_nodes)]
+        for leaving_user in events[3]:
+            position, channel_id, access_id = trace.viewers[leaving_user]
+            leaving_users[position][access_id] += 1
+            system.add_viewers(position, channel_id, -1)
+        server_access_numbers = system.server_access # server => {channel => number of users accessing here}
+        remove_users(leaving_users, topology, system)
+    with timer.phase('tree_shrink'):
+        shrink_delivery_tree(server_access_numbers, events[1], topology, system)
+    if verbose:
+        print "Leaving user removed!"
 
-    # for u, v in topology.topo.edges_iter():
-    #     print topology.topo.edge[u][v]['capacity']
+    # Add new channels
+    with timer.phase('channel_addition'):
+        system.ensure_channels(trace.number_of_channels)
+        for channel in events[0]:
+            system.channels[channel]['src'] = topology.get_nearest_server(trace.channels[channel])
+            system.channels[channel]['sites'] = []
+    if verbose:
+        print "New channels prepared!"
 
-    return failed_access, len(failed_channels)
+    with timer.phase('compute'):
+        algo = algorithm(topology, trace, system, events)
+        # Compute deliver tree and access points for current trace. The results should be stored in system
+        channels_with_new_delivery_tree, new_delivery_tree = algo.compute(incremental=incremental, workers=workers)
+    if verbose:
+        print "Algorithm computation complete!"
+    # Update network status based on updated system
+    with timer.phase('update_network_status'):
+        failed_access, admitted_edges, failed_channels = update_network_status(topology, trace, system, events,
+                                                                               channels_with_new_delivery_tree,
+                                                                               new_delivery_tree,
+                                                                               incremental=incremental, rng=rng,
+                                                                               admission=admission)
+    timer.end_round(topology, system, failed_access, len(failed_channels), len(channels_with_new_delivery_tree))
+    return failed_access, admitted_edges, failed_channels
 
 
 if __name__ == "__main__":
@@ -196,62 +286,26 @@ if __name__ == "__main__":
     with open('topo/nsfnet.json') as sample_topo:
         data = json.load(sample_topo)
         topology = Topology(data)
-        for node in topology.topo.nodes():
-            print topology.topo.node[node]
-        for u, v in topology.topo.edges_iter():
-            print topology.topo.edge[u][v]
-        print topology.routing
-
-    # Initialize trace
-    # with open('new_trace_pickle') as new_trace:
-    #     trace = pickle.load(new_trace)
-    #     rounds = len(trace.events)
-    #     print "Pickle object loaded"
+        for u in xrange(topology.number_of_nodes):
+            for k in xrange(topology.adjacency_indptr[u], topology.adjacency_indptr[u + 1]):
+                edge = topology.adjacency_edges[k]
+                print (u, topology.adjacency_nodes[k]), {'id': edge, 'bandwidth': topology.state.bandwidth[edge]}
+        print topology.state.capacity, topology.state.cost
+        print topology.state.server
+        print topology.state.qoe
+        print topology.predecessor
+        print topology.hops
+
+    # Initialize trace, rounds are read lazily as the loop asks for them
     trace = Trace('trace/')
-    rounds = len(trace.events)
 
     # Initialize system
     system = System(topology)
 
-    for round_no in xrange(rounds):
-        # Remove leaving channels
-        for leaving_channel in trace.events[round_no][1]:
-            del trace.channels[leaving_channel]
-            remove_channel(leaving_channel, topology, system)
-        print "Leaving channels removed!"
-
-        # Remove leaving users
-        leaving_users = [defaultdict(int) for _ in xrange(topology.topo.number_of_nodes())]
-        server_access_numbers = defaultdict(lambda : defaultdict(int)) # server => {channel => number of users accessing here}
-        for pos in xrange(topology.topo.number_of_nodes()):
-            for channel in system.access_point[pos].iterkeys():
-                for ap, prob in system.access_point[pos][channel].iteritems():
-                    server_access_numbers[ap][channel] += system.viewers[pos][channel] * prob
-        for leaving_user in trace.events[round_no][3]:
-            position, channel_id, access_id = trace.viewers[leaving_user]
-            del trace.viewers[leaving_user]
-            leaving_users[position][access_id] += 1
-            system.viewers[position][channel_id] -= 1
-            server_access_numbers[access_id][channel_id] -= 1
-        remove_users(leaving_users, topology, system)
-        shrink_delivery_tree(server_access_numbers, trace.events[round_no][1], topology, system)
-        print "Leaving user removed!"
-
-        # Add new channels
-        for channel in trace.events[round_no][0]:
-            system.channels[channel]['src'] = topology.get_nearest_server(trace.channels[channel])
-            system.channels[channel]['sites'] = []
-        print "New channels prepared!"
+    # Per-round JSON records go to the file given as first argument, if any
+    timer = NULL_TIMER
+    if len(sys.argv) > 1:
+        timer = RoundMetrics(open(sys.argv[1], 'w'))
 
-        algo = Multicast(topology, trace, system, round_no)
-        # Compute deliver tree and access points for current trace. The results should be stored in system
-        channels_with_new_delivery_tree, new_delivery_tree = algo.compute(incremental=True)
-        print "Algorithm computation complete!"
-        # Update network status based on updated system
-        failed_access, failed_deliver = update_network_status(topology, trace, system, round_no,
-                                                              channels_with_new_delivery_tree,
-                                                              new_delivery_tree, incremental=True)
-        print failed_access, failed_deliver, len(channels_with_new_delivery_tree)
-
-        # Remove expiring events
-        trace.events[round_no] = [[], [], [], []]
+    for failed_access, failed_deliver, new_trees in simulate(topology, trace, system, timer=timer):
+        print failed_access, failed_deliver, new_trees
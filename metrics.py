@@ -0,0 +1,65 @@
+import json
+import numpy as np
+from timing import PhaseTimer
+
+UTILIZATION_PERCENTILES = (50, 95, 99)
+QOE_PERCENTILES = (1, 10, 50)
+
+
+class RoundMetrics(PhaseTimer):
+    """Phase timer that also writes one JSON record per round to out."""
+    def __init__(self, out):
+        super(RoundMetrics, self).__init__()
+        self.out = out
+        self.round_no = 0
+
+    def end_round(self, topology, system, failed_access, failed_deliver, new_trees):
+        record = {'round': self.round_no,
+                  'failed_access': int(failed_access),
+                  'failed_deliver': int(failed_deliver),
+                  'new_trees': int(new_trees),
+                  'links': link_utilization(topology.state),
+                  'servers': server_load(topology),
+                  'qoe': qoe_summary(topology),
+                  'phases': dict((name, {'wall': self.seconds[name], 'cpu': self.cpu_seconds[name]})
+                                 for name in self.seconds)}
+        self.out.write(json.dumps(record, sort_keys=True) + '\n')
+        self.out.flush()
+        self.round_no += 1
+        self.reset()
+
+
+def link_utilization(state):
+    # Share of each link's bandwidth reserved by delivery trees
+    utilization = (state.bandwidth - state.capacity) / state.bandwidth.astype(np.float64)
+    summary = {'mean': float(utilization.mean()), 'max': float(utilization.max()),
+               'saturated': int((state.capacity <= 0).sum())}
+    for percentile, value in zip(UTILIZATION_PERCENTILES, np.percentile(utilization, UTILIZATION_PERCENTILES)):
+        summary['p{}'.format(percentile)] = float(value)
+    return summary
+
+
+def server_load(topology):
+    # Viewers served per server and the share of its capacity in use
+    state = topology.state
+    servers = sorted(topology.servers)
+    used = state.init_server[servers] - state.server[servers]
+    load = used / np.maximum(state.init_server[servers], 1).astype(np.float64)
+    return {'used': dict((str(server), int(value)) for server, value in zip(servers, used)),
+            'mean': float(load.mean()) if servers else 0.0,
+            'max': float(load.max()) if servers else 0.0}
+
+
+def qoe_summary(topology, worst=5):
+    # Total QoE, QoE per server, percentiles over positions and the `worst` positions with the lowest QoE
+    state = topology.state
+    servers = sorted(topology.servers)
+    by_server = state.qoe_by_server()
+    by_position = state.qoe_by_position()
+    summary = {'total': int(by_position.sum()),
+               'servers': dict((str(server), int(by_server[server])) for server in servers),
+               'worst': [[int(position), int(by_position[position])]
+                         for position in np.argsort(by_position, kind='mergesort')[:worst]]}
+    for percentile, value in zip(QOE_PERCENTILES, np.percentile(by_position, QOE_PERCENTILES)):
+        summary['p{}'.format(percentile)] = float(value)
+    return summary
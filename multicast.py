@@ -1,44 +1,41 @@
-from collections import deque
 from collections import defaultdict
-import networkx as nx
+import multiprocessing
+import os
+import numpy as np
 
 
 class Multicast(object):
-    def __init__(self, topology, trace, system, round_no):
+    def __init__(self, topology, trace, system, events):
         self.topology = topology
         self.trace = trace
         self.system = system
-        self.round_no = round_no
+        self.events = events
 
-    def compute(self, incremental=True):
+    def compute(self, incremental=True, workers=1):
         channels_with_new_delivery_tree = set()
         new_delivery_tree = defaultdict(lambda: defaultdict(list))
 
         # assign access point
-        for new_viewer_id in self.trace.events[self.round_no][2]:
+        for new_viewer_id in self.events[2]:
             position, channel, access_point = self.trace.viewers[new_viewer_id]
 
             # If this position already has an access point for this channel
-            if channel in self.system.access_point[position]:
-                self.trace.viewers[new_viewer_id][2] = self.system.access_point[position][channel].keys()[0]
+            if (position, channel) in self.system.access_point:
+                self.trace.viewers[new_viewer_id][2] = self.system.access_point.get(position, channel).keys()[0]
                 continue
 
             # Assign nearest server as access_point
             server = self.topology.get_nearest_server(position)
             self.trace.viewers[new_viewer_id][2] = server
-            self.system.access_point[position][channel] = {server: 1}
+            self.system.set_access_point(position, channel, {server: 1})
 
             # Check whether the chosen server is on delivery tree of this channel
             servers = [self.system.channels[channel]['src']] + self.system.channels[channel]['sites']
             if server not in servers:
                 if incremental:
                     # Add a link from the nearest other server with channel available to the current server in delivery tree
-                    min_hops, nearest_source = None, None
-                    for source in servers:
-                        if min_hops == None or len(self.topology.routing[server][source]) < min_hops:
-                            min_hops = len(self.topology.routing[server][source])
-                            nearest_source = source
-                    new_delivery_tree[server][source].append(channel)
+                    nearest_source = self.topology.get_nearest_server(server, servers)
+                    new_delivery_tree[server][nearest_source].append(channel)
                 self.system.channels[channel]['sites'].append(server)
                 channels_with_new_delivery_tree.add(channel)
 
@@ -47,34 +44,72 @@ class Multicast(object):
             # If incremental, we've already appended new server to delivery tree
             return channels_with_new_delivery_tree, new_delivery_tree
 
-        # Compute new delivery trees
-        for channel in channels_with_new_delivery_tree:
-            servers = [self.system.channels[channel]['src']] + self.system.channels[channel]['sites']
-            # compute delivery tree
-            # make overlay graph
-            G = nx.Graph()
-            G.add_nodes_from(servers)
-            for i in xrange(len(servers)):
-                for j in xrange(i+1, len(servers)):
-                    u, v = servers[i], servers[j]
-                    links = []
-                    path = self.topology.routing[u][v]
-                    for k in xrange(1, len(path)):
-                        links.append(self.topology.topo[path[k-1]][path[k]]['bandwidth'])
-                    G.add_edge(u, v, capacity=min(links))
-
-            # Get delivery tree from minimum spanning tree
-            T = nx.minimum_spanning_tree(G)
-            root = self.system.channels[channel]['src']
-            visited = set([])
-            queue = deque([root])
-            while queue:
-                node = queue.popleft()
-                for neighbor in T.neighbors(node):
-                    if neighbor in visited:
-                        continue
-                    new_delivery_tree[neighbor][node].append(channel)
-                    queue.append(neighbor)
-                visited.add(node)
-
-        return channels_with_new_delivery_tree, new_delivery_tree
\ No newline at end of file
+        # Compute new delivery trees on the overlay of the channel's servers, weighted by path bottleneck bandwidth
+        # Channels are merged in id order, so the result does not depend on the number of workers
+        bottleneck = self.topology.get_bottleneck()
+        channels = sorted(channels_with_new_delivery_tree)
+        tasks = [[self.system.channels[channel]['src']] + self.system.channels[channel]['sites'] for channel in channels]
+        if workers > 1 and len(tasks) > 1:
+            trees = tree_pool(bottleneck, workers).map(_worker_spanning_tree, tasks,
+                                                       chunksize=max(1, len(tasks) // (4 * workers)))
+        else:
+            trees = [spanning_tree(servers, bottleneck) for servers in tasks]
+        for channel, edges in zip(channels, trees):
+            for node, parent in edges:
+                new_delivery_tree[node][parent].append(channel)
+
+        return channels_with_new_delivery_tree, new_delivery_tree
+
+
+def spanning_tree(servers, bottleneck):
+    # Prim's algorithm from servers[0] keeping the widest overlay links, returns (node, parent) edges.
+    # Ties go to the server listed first.
+    number = len(servers)
+    weight = bottleneck[np.ix_(servers, servers)].astype(np.float64)
+    in_tree = np.zeros(number, dtype=bool)
+    in_tree[0] = True
+    best = weight[0].copy()
+    parent = np.zeros(number, dtype=np.int64)
+    edges = []
+    for _ in xrange(number - 1):
+        node = np.argmax(np.where(in_tree, -np.inf, best))
+        in_tree[node] = True
+        edges.append((servers[node], servers[parent[node]]))
+        wider = ~in_tree & (weight[node] > best)
+        best[wider] = weight[node][wider]
+        parent[wider] = node
+    return edges
+
+
+# (bottleneck, workers, pool, pid of the process that started it) of the running worker pool
+_pool = None
+# Bottleneck matrix of a worker process, inherited from the parent when the pool forks
+_worker_bottleneck = None
+
+
+def tree_pool(bottleneck, workers):
+    # Workers are forked once per bottleneck matrix and keep it, so a task only carries its server list
+    global _pool
+    if _pool is None or _pool[0] is not bottleneck or _pool[1] != workers or _pool[3] != os.getpid():
+        close_tree_pool()
+        _pool = (bottleneck, workers, multiprocessing.Pool(workers, _init_worker, (bottleneck,)), os.getpid())
+    return _pool[2]
+
+
+def close_tree_pool():
+    global _pool
+    # A forked child (checkpoint.run_forked) inherits the pool object but not its handler threads, it only
+    # drops it and leaves the workers to the process that started them
+    if _pool is not None and _pool[3] == os.getpid():
+        _pool[2].terminate()
+        _pool[2].join()
+    _pool = None
+
+
+def _init_worker(bottleneck):
+    global _worker_bottleneck
+    _worker_bottleneck = bottleneck
+
+
+def _worker_spanning_tree(servers):
+    return spanning_tree(servers, _worker_bottleneck)
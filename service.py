@@ -0,0 +1,187 @@
+#!/usr/bin/python
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import sys
+import time
+from collections import defaultdict
+import numpy as np
+from main import simulate_round
+from system import System
+from topology import Topology
+from trace import Trace
+
+
+class Service(object):
+    """Online mode: s/v records arrive one line at a time and are cut into rounds by their seq field.
+
+    Records whose seq falls in the same window of `window` seq values form one round. The round runs when the
+    first record of a later window arrives (or the stream ends), and its access point and delivery tree
+    decisions are written out as JSON lines right away.
+    """
+    def __init__(self, topology, out=sys.stdout, window=1, incremental=True, admission='greedy', rng=random,
+                 errors=sys.stderr):
+        self.topology = topology
+        self.trace = Trace(None, rng=rng, verbose=False, locations=topology.locations)
+        self.system = System(topology)
+        self.out = out
+        # Malformed records are skipped with a message here instead of stopping the stream
+        self.errors = errors
+        self.rejected = 0
+        self.window = window
+        self.incremental = incremental
+        self.admission = admission
+        self.rng = rng
+        # Seconds from the first record behind a decision to the decision being written
+        self.latencies = []
+        self._window_no = None
+        self._lines = []
+        # (position, liveId) => arrival of its first v record, liveId => arrival of its first record
+        self._viewer_arrival = {}
+        self._channel_arrival = {}
+
+    def feed(self, line):
+        arrival = time.time()
+        line = line.strip()
+        if not line:
+            return
+        error = self._check(line)
+        if error is not None:
+            self.rejected += 1
+            self.errors.write('rejected record, {}: {}\n'.format(error, line))
+            return
+        seq, cType, cPos, cPosState, cTarget, cTargetState, liveId = line.split(',')
+        # seq is parsed as the trace parses it, fractional timestamps included
+        window_no = int(float(seq) // self.window)
+        if self._window_no is not None and window_no != self._window_no:
+            self.flush()
+        self._window_no = window_no
+        self._lines.append(line)
+        self._channel_arrival.setdefault(liveId, arrival)
+        if cType == "v":
+            self._viewer_arrival.setdefault((self.trace.locations[cPos], liveId), arrival)
+
+    def _check(self, line):
+        # Why the record cannot be parsed, None when it is a valid s/v record
+        fields = line.split(',')
+        if len(fields) != 7:
+            return '{} fields instead of 7'.format(len(fields))
+        seq, cType, cPos, cPosState, cTarget, cTargetState, liveId = fields
+        try:
+            seq = float(seq)
+        except ValueError:
+            return 'seq {!r} is not a number'.format(seq)
+        if math.isnan(seq) or math.isinf(seq):
+            return 'seq {!r} is not finite'.format(seq)
+        if cType not in ('s', 'v'):
+            return 'unknown record type {!r}'.format(cType)
+        for location in (cPos, cTarget):
+            if location not in self.trace.locations:
+                return 'unknown location {!r}'.format(location)
+        if not liveId:
+            return 'empty liveId'
+        return None
+
+    def flush(self):
+        # Run the buffered round and write its decisions
+        if not self._lines:
+            return
+        trace, system = self.trace, self.system
+        events = trace.push_round(self._lines, name='window {}'.format(self._window_no))
+        failed_access, admitted_edges, failed_channels = simulate_round(
+            self.topology, trace, system, events, incremental=self.incremental, rng=self.rng, verbose=False,
+            admission=self.admission)
+
+        # One access decision per (position, channel) that got new viewers
+        new_viewers = defaultdict(int)
+        for viewer_id in events[2]:
+            position, channel, access_point = trace.viewers[viewer_id]
+            new_viewers[(position, channel, access_point)] += 1
+        for (position, channel, access_point), viewer_number in sorted(new_viewers.iteritems()):
+            live_id = trace.channel_name(channel)
+            self._emit({'type': 'access', 'round': trace.round_no, 'position': position, 'channel': live_id,
+                        'server': access_point, 'viewers': viewer_number},
+                       self._viewer_arrival[(position, live_id)])
+        # One tree decision per channel with a new delivery tree, listing only the edges it added
+        for channel in sorted(set(admitted_edges) | failed_channels):
+            live_id = trace.channel_name(channel)
+            self._emit({'type': 'tree', 'round': trace.round_no, 'channel': live_id,
+                        'admitted': channel in admitted_edges, 'edges': sorted(admitted_edges.get(channel, []))},
+                       self._channel_arrival[live_id])
+        self._emit({'type': 'round', 'round': trace.round_no, 'failed_access': int(failed_access),
+                    'failed_deliver': len(failed_channels), 'new_trees': len(admitted_edges) + len(failed_channels)})
+        self.out.flush()
+
+        self._lines = []
+        self._viewer_arrival.clear()
+        self._channel_arrival.clear()
+
+    def _emit(self, decision, arrival=None):
+        if arrival is not None:
+            latency = time.time() - arrival
+            self.latencies.append(latency)
+            decision['latency'] = latency
+        self.out.write(json.dumps(decision) + '\n')
+
+    def latency_report(self, percentiles=(50, 90, 99)):
+        if not self.latencies:
+            return {'decisions': 0}
+        latencies = np.array(self.latencies)
+        report = dict(('p{}'.format(percentile), value)
+                      for percentile, value in zip(percentiles, np.percentile(latencies, percentiles)))
+        report.update(decisions=len(latencies), max=latencies.max(), mean=latencies.mean())
+        return report
+
+    def serve(self, stream):
+        # Feed every line of stream, then run the last round
+        try:
+            for line in iter(stream.readline, ''):
+                self.feed(line)
+            self.flush()
+        except KeyboardInterrupt:
+            pass
+        report = self.latency_report()
+        report['rejected'] = self.rejected
+        return report
+
+
+def open_stream(socket_path=None, port=None):
+    # stdin, or the first connection on a unix socket or a 127.0.0.1 port
+    if socket_path is None and port is None:
+        return sys.stdin
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', port))
+    server.listen(1)
+    connection, _ = server.accept()
+    server.close()
+    return connection.makefile('r')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Place a live s/v record stream, one JSON decision per line")
+    parser.add_argument('--topology', default='topo/nsfnet.json')
+    parser.add_argument('--window', type=int, default=1, help="seq values per round")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--socket', default=None, help="unix socket path to listen on instead of stdin")
+    source.add_argument('--port', type=int, default=None, help="127.0.0.1 port to listen on instead of stdin")
+    parser.add_argument('--full', action='store_true', help="recompute delivery trees instead of incremental")
+    parser.add_argument('--admission', default='greedy', choices=['greedy', 'knapsack'])
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.topology) as topo_file:
+        topology = Topology(json.load(topo_file))
+    rng = random.Random(args.seed) if args.seed is not None else random
+    service = Service(topology, window=args.window, incremental=not args.full, admission=args.admission, rng=rng)
+    report = service.serve(open_stream(args.socket, args.port))
+    sys.stderr.write(json.dumps(report) + '\n')
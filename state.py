@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class NetworkState(object):
+    # Mutable per-round arrays; everything else in Topology is read-only structure
+    FIELDS = ('capacity', 'cost', 'server', 'qoe')
+
+    def __init__(self, topo_json):
+        number_of_nodes = topo_json['number_of_nodes']
+        edge_list = topo_json['edge_list']
+
+        # Links indexed by edge id
+        self.bandwidth = np.array([edge[2] for edge in edge_list], dtype=np.int64)
+        self.init_capacity = self.bandwidth.copy()
+        self.init_cost = np.array([edge[3] for edge in edge_list], dtype=np.int64)
+
+        # Server capacity indexed by node, 0 on nodes without a server
+        self.init_server = np.zeros(number_of_nodes, dtype=np.int64)
+        self.is_server = np.zeros(number_of_nodes, dtype=bool)
+        for node, capacity in topo_json['servers'].iteritems():
+            self.init_server[int(node)] = capacity
+            self.is_server[int(node)] = True
+
+        # qoe[server][position], rows of nodes without qoe stay 0
+        self.init_qoe = np.zeros((number_of_nodes, number_of_nodes), dtype=np.int64)
+        self.has_qoe = np.zeros(number_of_nodes, dtype=bool)
+        for node, qoe in topo_json['qoe'].iteritems():
+            self.init_qoe[int(node)] = qoe
+            self.has_qoe[int(node)] = True
+
+        self.capacity = self.init_capacity.copy()
+        self.cost = self.init_cost.copy()
+        self.server = self.init_server.copy()
+        self.qoe = self.init_qoe.copy()
+
+    def reset(self):
+        # Restore every mutable array to its init_* value in place
+        for field in self.FIELDS:
+            np.copyto(getattr(self, field), getattr(self, 'init_' + field))
+
+    def add_qoe(self, cells, deltas):
+        # Apply a batch of deltas to [(server, position)] cells, repeated cells add up
+        servers, positions = zip(*cells)
+        np.add.at(self.qoe, (servers, positions), np.asarray(deltas, dtype=self.qoe.dtype))
+
+    def qoe_by_server(self):
+        # QoE summed over positions, for every node (0 on nodes without qoe)
+        return self.qoe.sum(axis=1)
+
+    def qoe_by_position(self):
+        # QoE each position receives, summed over servers
+        return self.qoe.sum(axis=0)
+
+    def snapshot(self):
+        return dict((field, getattr(self, field).copy()) for field in self.FIELDS)
+
+    def restore(self, snapshot):
+        for field in self.FIELDS:
+            np.copyto(getattr(self, field), snapshot[field])
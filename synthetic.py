@@ -0,0 +1,180 @@
+#!/usr/bin/python
+import argparse
+import json
+import math
+import os
+import random
+import numpy as np
+from trace import LOCATIONS
+
+
+def topology_json(number_of_nodes, edges, servers, server_capacity=1000, locations=None):
+    # Same layout as topo/*.json, plus a location name => node table the trace generator writes against
+    if locations is None:
+        locations = range(number_of_nodes)
+    return {'number_of_nodes': number_of_nodes,
+            'edge_list': [list(edge) for edge in edges],
+            'servers': dict((str(server), server_capacity) for server in servers),
+            'qoe': dict((str(server), [0] * number_of_nodes) for server in servers),
+            'locations': dict(('n{}'.format(node), node) for node in locations)}
+
+
+def fat_tree(k, bandwidth=1000, cost=100, server_capacity=1000):
+    # k-ary fat-tree of switches: (k/2)^2 core, then per pod k/2 aggregation and k/2 edge switches.
+    # Viewers sit on edge switches, every pod has one server on its first edge switch.
+    half = k // 2
+    core = range(half * half)
+    edges, servers, locations = [], [], []
+    for pod in xrange(k):
+        first = len(core) + pod * k
+        aggregation, edge = range(first, first + half), range(first + half, first + k)
+        for i, agg in enumerate(aggregation):
+            for j in xrange(half):
+                edges.append((core[i * half + j], agg, bandwidth, cost))
+            for switch in edge:
+                edges.append((agg, switch, bandwidth, cost))
+        servers.append(edge[0])
+        locations += edge
+    return topology_json(len(core) + k * k, edges, servers, server_capacity, locations)
+
+
+def random_geometric(number_of_nodes, radius=None, number_of_servers=None, bandwidth=1000, cost_per_unit=3000,
+                     server_capacity=1000, rng=None):
+    # Nodes uniform in the unit square, linked when closer than radius; components are stitched together
+    # through their closest node pair so every node is reachable
+    rng = rng or random.Random(0)
+    if radius is None:
+        radius = 1.5 * math.sqrt(math.log(max(number_of_nodes, 2)) / (math.pi * number_of_nodes))
+    points = np.array([(rng.random(), rng.random()) for _ in xrange(number_of_nodes)])
+    distance = np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+
+    def link(u, v):
+        return (int(u), int(v), bandwidth, int(cost_per_unit * distance[u, v]) + 1)
+
+    edges = [link(u, v) for u, v in zip(*np.nonzero(np.triu(distance < radius, 1)))]
+    component = _components(number_of_nodes, edges)
+    while len(set(component)) > 1:
+        inside = np.array(component) == component[0]
+        between = np.where(inside[:, None] & ~inside[None, :], distance, np.inf)
+        u, v = np.unravel_index(np.argmin(between), between.shape)
+        edges.append(link(u, v))
+        component = _components(number_of_nodes, edges)
+
+    if number_of_servers is None:
+        number_of_servers = max(3, number_of_nodes // 5)
+    servers = sorted(rng.sample(xrange(number_of_nodes), min(number_of_servers, number_of_nodes)))
+    return topology_json(number_of_nodes, edges, servers, server_capacity)
+
+
+def scaled_nsfnet(copies, base_json, bandwidth=1000, cost=2000):
+    # Copies of a WAN topology chained into one network, each copy keeps its own servers and
+    # copy i links to copy i + 1 through the base's first and last node
+    number_of_nodes = base_json['number_of_nodes']
+    edges, servers = [], []
+    for copy in xrange(copies):
+        offset = copy * number_of_nodes
+        for u, v, edge_bandwidth, edge_cost in base_json['edge_list']:
+            edges.append((u + offset, v + offset, edge_bandwidth, edge_cost))
+        servers += [int(server) + offset for server in base_json['servers']]
+        if copy > 0:
+            edges.append((offset - 1, offset, bandwidth, cost))
+            edges.append((offset - number_of_nodes, offset + number_of_nodes - 1, bandwidth, cost))
+    server_capacity = max(base_json['servers'].values())
+    return topology_json(copies * number_of_nodes, edges, servers, server_capacity)
+
+
+def _components(number_of_nodes, edges):
+    parent = range(number_of_nodes)
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for u, v, _, _ in edges:
+        parent[find(u)] = find(v)
+    return [find(node) for node in xrange(number_of_nodes)]
+
+
+def synthetic_trace(out_dir, topo_json, rounds=20, channels=300, viewers=8000, lifetime=10, zipf=1.0,
+                    flash_crowds=0, flash_size=20, seed=0):
+    # Write round files 1..rounds in the s/v format of trace/. Around `channels` channels are live each round,
+    # a channel ends with probability 1 / lifetime per round and is replaced by a new one. `viewers` requests
+    # per round are spread over channels by Zipf popularity and over locations uniformly. In each of
+    # `flash_crowds` random rounds one channel gets flash_size times its fair share of extra viewers.
+    rng = random.Random(seed)
+    numbers = np.random.RandomState(seed)
+    # Topologies without a location table (the shipped ones) use the table Trace falls back to
+    table = topo_json.get('locations')
+    if table is None:
+        table = LOCATIONS
+    locations = sorted(table, key=table.get)
+    flash_rounds = set(rng.sample(xrange(1, rounds + 1), min(flash_crowds, rounds)))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    live, next_id = {}, 0
+    for round_no in xrange(1, rounds + 1):
+        for channel in live.keys():
+            if rng.random() < 1.0 / lifetime:
+                del live[channel]
+        while len(live) < channels:
+            # liveId => (source location, popularity weight)
+            live[str(10 ** 14 + next_id)] = (rng.choice(locations), 1.0 / (rng.randint(1, channels) ** zipf))
+            next_id += 1
+
+        names = sorted(live)
+        weights = np.array([live[name][1] for name in names])
+        requests = numbers.multinomial(viewers, weights / weights.sum())
+        if round_no in flash_rounds:
+            requests[rng.randrange(len(names))] += flash_size * viewers // len(names)
+
+        with open(os.path.join(out_dir, str(round_no)), 'w') as out:
+            for name in names:
+                source = live[name][0]
+                out.write('{0},s,{1}, XX,{1}, XX,{2}\n'.format(round_no, source, name))
+            for name, request_no in zip(names, requests):
+                source = live[name][0]
+                per_location = numbers.multinomial(request_no, [1.0 / len(locations)] * len(locations))
+                for location, number in zip(locations, per_location):
+                    line = '{0},v,{1}, XX,{2}, XX,{3}\n'.format(round_no, location, source, name)
+                    out.write(line * number)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic topologies and s/v traces")
+    commands = parser.add_subparsers(dest='command')
+    topology_parser = commands.add_parser('topology')
+    topology_parser.add_argument('kind', choices=['fattree', 'geometric', 'nsfnet'])
+    topology_parser.add_argument('size', type=int, help="k for fattree, nodes for geometric, copies for nsfnet")
+    topology_parser.add_argument('output')
+    topology_parser.add_argument('--seed', type=int, default=0)
+    trace_parser = commands.add_parser('trace')
+    trace_parser.add_argument('topology')
+    trace_parser.add_argument('output', help="directory for the round files")
+    trace_parser.add_argument('--rounds', type=int, default=20)
+    trace_parser.add_argument('--channels', type=int, default=300)
+    trace_parser.add_argument('--viewers', type=int, default=8000)
+    trace_parser.add_argument('--lifetime', type=float, default=10)
+    trace_parser.add_argument('--flash-crowds', type=int, default=0)
+    trace_parser.add_argument('--flash-size', type=int, default=20)
+    trace_parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'topology':
+        if args.kind == 'fattree':
+            data = fat_tree(args.size)
+        elif args.kind == 'geometric':
+            data = random_geometric(args.size, rng=random.Random(args.seed))
+        else:
+            with open('topo/nsfnet.json') as base:
+                data = scaled_nsfnet(args.size, json.load(base))
+        with open(args.output, 'w') as out:
+            json.dump(data, out)
+    else:
+        with open(args.topology) as topo_file:
+            data = json.load(topo_file)
+        synthetic_trace(args.output, data, rounds=args.rounds, channels=args.channels, viewers=args.viewers,
+                        lifetime=args.lifetime, flash_crowds=args.flash_crowds, flash_size=args.flash_size,
+                        seed=args.seed)
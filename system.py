@@ -1,4 +1,5 @@
 from collections import defaultdict
+import numpy as np
 
 
 class System(object):
@@ -6,9 +7,186 @@ class System(object):
         self.topology = topology
         # channel_id -> {'sites'>[node], 'bw'->val, 'src'->source}
         self.channels = defaultdict(dict)
-        # [channel_id -> {server_id -> probability}]
-        self.access_point = [defaultdict(dict) for _ in xrange(topology.topo.number_of_nodes())]
-        # [channel_id -> number of viewers]
-        self.viewers = [defaultdict(int) for _ in xrange(topology.topo.number_of_nodes())]
-        # target -> {source -> channel_id_array}
-        self.delivery_tree = defaultdict(lambda : defaultdict(list))
+        # (position, channel_id) -> {server_id -> probability}
+        self.access_point = AccessTable()
+        # viewers[position][channel_id] -> number of viewers, grows with the channel ids seen
+        self.viewers = np.zeros((topology.number_of_nodes, 0), dtype=np.int64)
+        # server_access[server][channel_id] -> number of users accessing here, kept up to date on every
+        # viewer and access point change
+        self.server_access = np.zeros((topology.number_of_nodes, 0), dtype=np.float64)
+        # target -> {source -> set of channel_id}
+        self.delivery_tree = defaultdict(_channel_set_by_source)
+        # channel_id -> {(source, target)}, reverse index of delivery_tree
+        self.tree_edges = defaultdict(set)
+        # channel_id -> {node -> number of targets it delivers to}
+        self.tree_children = defaultdict(_counter)
+        # (server, channel_id) pairs whose access number fell or whose tree edges changed since the last
+        # tree shrink, the only pairs that can have become prunable
+        self.touched = set()
+
+    def __getstate__(self):
+        # The topology is shared, not saved, checkpoint.restore() attaches it again
+        state = dict(self.__dict__)
+        del state['topology']
+        return state
+
+    def ensure_channels(self, number_of_channels):
+        # Channel ids are dense, so tables only need to grow to the largest id seen
+        if number_of_channels > self.viewers.shape[1]:
+            self.viewers = _grow_columns(self.viewers, number_of_channels)
+            self.server_access = _grow_columns(self.server_access, number_of_channels)
+
+    def add_viewers(self, position, channel, number):
+        self.viewers[position, channel] += number
+        for server, probability in self.access_point.get(position, channel).iteritems():
+            self.server_access[server, channel] += number * probability
+            if number < 0:
+                self.touched.add((server, channel))
+
+    def set_access_point(self, position, channel, server_probability):
+        # Move the position's current viewers from the old access servers to the new ones
+        viewer_number = self.viewers[position, channel]
+        for server, probability in self.access_point.get(position, channel).iteritems():
+            self.server_access[server, channel] -= viewer_number * probability
+            self.touched.add((server, channel))
+        self.access_point.set(position, channel, server_probability)
+        for server, probability in server_probability.iteritems():
+            self.server_access[server, channel] += viewer_number * probability
+            self.touched.add((server, channel))
+
+    def remove_channel(self, channel):
+        del self.channels[channel]
+        self.access_point.remove_channel(channel)
+        self.viewers[:, channel] = 0
+        self.server_access[:, channel] = 0
+        self.remove_tree(channel)
+
+    def add_tree_edge(self, channel, source, target):
+        if channel in self.delivery_tree[target][source]:
+            return
+        self.delivery_tree[target][source].add(channel)
+        self.tree_edges[channel].add((source, target))
+        self.tree_children[channel][source] += 1
+        self.touched.add((target, channel))
+
+    def remove_tree_edge(self, channel, source, target):
+        self.delivery_tree[target][source].remove(channel)
+        self.tree_edges[channel].remove((source, target))
+        children = self.tree_children[channel]
+        children[source] -= 1
+        if children[source] == 0:
+            del children[source]
+            self.touched.add((source, channel))
+
+    def remove_tree(self, channel):
+        # Drop every edge of one channel, returns the removed (source, target) edges
+        edges = self.tree_edges.pop(channel, set())
+        for source, target in edges:
+            self.delivery_tree[target][source].remove(channel)
+            self.touched.add((source, channel))
+            self.touched.add((target, channel))
+        self.tree_children.pop(channel, None)
+        return edges
+
+    def get_tree_edges(self, channel):
+        return self.tree_edges.get(channel, set())
+
+    def get_children_number(self, channel, node):
+        return self.tree_children[channel].get(node, 0) if channel in self.tree_children else 0
+
+    def get_tree_parents(self, channel, node):
+        if node not in self.delivery_tree:
+            return []
+        return [source for source, channel_set in self.delivery_tree[node].iteritems() if channel in channel_set]
+
+
+class AccessTable(object):
+    """Sparse (position, channel) -> {server: probability} map stored as parallel slot arrays."""
+    def __init__(self):
+        self.position = np.zeros(0, dtype=np.int64)
+        self.channel = np.zeros(0, dtype=np.int64)
+        self.server = np.zeros(0, dtype=np.int64)
+        self.probability = np.zeros(0, dtype=np.float64)
+        # (position, channel) -> [slot]
+        self._slots = {}
+        # channel -> set of positions with an access point
+        self._positions = defaultdict(set)
+        # (server, channel) -> number of slots with a nonzero probability
+        self._servers = defaultdict(int)
+        self._free = []
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def get(self, position, channel):
+        return dict((int(self.server[slot]), self.probability[slot]) for slot in self._slots.get((position, channel), ()))
+
+    def set(self, position, channel, server_probability):
+        self.discard(position, channel)
+        slots = []
+        for server, probability in server_probability.iteritems():
+            slot = self._allocate()
+            self.position[slot], self.channel[slot] = position, channel
+            self.server[slot], self.probability[slot] = server, probability
+            slots.append(slot)
+            if probability != 0:
+                self._servers[(server, channel)] += 1
+        self._slots[(position, channel)] = slots
+        self._positions[channel].add(position)
+
+    def discard(self, position, channel):
+        for slot in self._slots.pop((position, channel), ()):
+            if self.probability[slot] != 0:
+                key = (int(self.server[slot]), channel)
+                self._servers[key] -= 1
+                if self._servers[key] == 0:
+                    del self._servers[key]
+            # Freed slots keep probability 0, so they drop out of every reduction
+            self.probability[slot] = 0
+            self._free.append(slot)
+        if channel in self._positions:
+            self._positions[channel].discard(position)
+
+    def remove_channel(self, channel):
+        for position in self.positions(channel):
+            self.discard(position, channel)
+        self._positions.pop(channel, None)
+
+    def positions(self, channel):
+        return list(self._positions.get(channel, ()))
+
+    def items(self, channel):
+        # (position, {server -> probability}) of one channel
+        for position in self.positions(channel):
+            yield position, self.get(position, channel)
+
+    def has_server(self, server, channel):
+        # Whether any position of the channel accesses it through server
+        return (server, channel) in self._servers
+
+    def _allocate(self):
+        if not self._free:
+            # Double every column and hand out the new slots lowest first
+            size = len(self.probability)
+            capacity = max(2 * size, 16)
+            for name in ('position', 'channel', 'server', 'probability'):
+                column = getattr(self, name)
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:size] = column
+                setattr(self, name, grown)
+            self._free.extend(xrange(capacity - 1, size - 1, -1))
+        return self._free.pop()
+
+
+def _channel_set_by_source():
+    return defaultdict(set)
+
+
+def _counter():
+    return defaultdict(int)
+
+
+def _grow_columns(array, number_of_columns):
+    grown = np.zeros((array.shape[0], max(number_of_columns, 2 * array.shape[1])), dtype=array.dtype)
+    grown[:, :array.shape[1]] = array
+    return grown
@@ -0,0 +1,57 @@
+from collections import defaultdict
+import time
+
+
+class PhaseTimer(object):
+    """Accumulates wall-clock and CPU seconds per named phase of the round loop."""
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.cpu_seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def end_round(self, topology, system, failed_access, failed_deliver, new_trees):
+        pass
+
+    def reset(self):
+        self.seconds.clear()
+        self.cpu_seconds.clear()
+        self.calls.clear()
+
+
+class _Phase(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        self.cpu_start = time.clock()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.seconds[self.name] += time.time() - self.start
+        self.timer.cpu_seconds[self.name] += time.clock() - self.cpu_start
+        self.timer.calls[self.name] += 1
+
+
+class NullTimer(object):
+    # Default timer: one shared no-op context, so untimed runs pay a single method call per phase
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def end_round(self, topology, system, failed_access, failed_deliver, new_trees):
+        pass
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+NULL_TIMER = NullTimer()
@@ -1,51 +1,276 @@
-import networkx as nx
+import numpy as np
+from scipy import sparse
+import hashlib
+import heapq
 import json
+import os
+import shutil
+import tempfile
+from state import NetworkState
+
+# Routing tables are cached here, one directory per topology hash
+ROUTING_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'routing')
+ROUTING_ARRAYS = ('predecessor', 'hops', 'incidence_indptr', 'incidence_indices')
+# Bumped whenever computed routes can change, so older cached tables are not reused
+ROUTING_VERSION = 3
 
 class Topology(object):
-    def __init__(self, topo_json):
-        G = nx.Graph()
-        # Read graph from json
-        G.add_nodes_from(range(topo_json['number_of_nodes']))
-        for i, (u, v, bandwidth, cost) in enumerate(topo_json['edge_list']):
-            G.add_edge(u, v, id = i, bandwidth = bandwidth, capacity = bandwidth, init_cost = cost, cost = cost)
+    def __init__(self, topo_json, cache_dir=ROUTING_CACHE):
+        # Read-only structural view of the graph, mutable state lives in self.state
+        self.topo_json = topo_json
+        self.number_of_nodes = number_of_nodes = topo_json['number_of_nodes']
+        self.number_of_edges = len(topo_json['edge_list'])
+        self._graph = None
+        # CSR adjacency: the neighbors of u are adjacency_nodes[adjacency_indptr[u]:adjacency_indptr[u + 1]] in
+        # increasing order, adjacency_edges holds the matching edge ids. A repeated (u, v) keeps its last id.
+        edges = np.array([edge[:2] for edge in topo_json['edge_list']], dtype=np.int64).reshape(-1, 2)
+        ids = np.arange(len(edges))
+        keys = np.concatenate([edges[:, 0] * number_of_nodes + edges[:, 1], edges[:, 1] * number_of_nodes + edges[:, 0]])
+        keys, last = np.unique(keys[::-1], return_index=True)
+        self.adjacency_keys = keys
+        self.adjacency_edges = np.concatenate([ids, ids])[::-1][last]
+        self.adjacency_nodes = keys % number_of_nodes
+        self.adjacency_indptr = np.searchsorted(keys, np.arange(number_of_nodes + 1) * number_of_nodes)
         self.servers = []
         for node in topo_json['servers']:
-            G.node[int(node)]['init_server'] = topo_json['servers'][node]
-            G.node[int(node)]['server'] = topo_json['servers'][node]
             self.servers.append(int(node))
-        for node in topo_json['qoe']:
-            G.node[int(node)]['init_qoe'] = topo_json['qoe'][node][:]
-            G.node[int(node)]['qoe'] = topo_json['qoe'][node][:]
-        self.topo = G
-
-        # Compute shortest paths
-        number_of_nodes = G.number_of_nodes()
-        self.routing = [[[] for _ in xrange(number_of_nodes)] for _ in xrange(number_of_nodes)]
-        for i in xrange(number_of_nodes):
-            paths = nx.single_source_shortest_path(G, i)
-            for j in xrange(number_of_nodes):
-                if j == i: continue
-                self.routing[i][j] = paths[j]
-
-    def get_nearest_server(self, pos):
-        server_hop = [(node, len(self.routing[pos][node]))
-                      for node in self.topo.nodes()
-                      if node in self.servers]
-        return min(server_hop, key=lambda x: x[1])[0]
+        # Optional location name => node table for traces recorded on this topology
+        self.locations = topo_json.get('locations')
+
+        # Link, server and qoe state as dense arrays
+        self.state = NetworkState(topo_json)
+
+        # Shortest paths as a predecessor matrix: predecessor[x][y] is the node before y on the path from x,
+        # hops[x][y] the path length. Together with the path-link incidence (row x * number_of_nodes + y
+        # marks the edge ids on the path) they are read-only and memory-mapped from the cache when possible.
+        arrays = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, '{}-{}'.format(topology_hash(topo_json), ROUTING_VERSION))
+            arrays = _load_routing(cache_path)
+            if arrays is None:
+                arrays = self._compute_routing()
+                _save_routing(cache_path, arrays)
+        else:
+            arrays = self._compute_routing()
+        self.predecessor, self.hops = arrays['predecessor'], arrays['hops']
+        indices = arrays['incidence_indices']
+        self.incidence = sparse.csr_matrix((np.ones(len(indices), dtype=np.int64), indices, arrays['incidence_indptr']),
+                                           shape=(number_of_nodes * number_of_nodes, self.number_of_edges))
+
+        # Server-to-server bottleneck bandwidth, built on first use
+        self._bottleneck = None
+
+        # Nearest-server index: node_rank[x][y] orders every y by (hops from x, node id), and
+        # server_order[x] lists the servers in that order
+        nodes = np.broadcast_to(np.arange(number_of_nodes), (number_of_nodes, number_of_nodes))
+        node_order = np.lexsort((nodes, self.hops), axis=1)
+        self.node_rank = np.empty((number_of_nodes, number_of_nodes), dtype=np.int32)
+        self.node_rank[np.arange(number_of_nodes)[:, None], node_order] = np.arange(number_of_nodes)
+        is_server = self.state.is_server[node_order]
+        self.server_order = node_order[is_server].reshape(number_of_nodes, len(self.servers))
+
+    @property
+    def topo(self):
+        # networkx view with 'id' and 'bandwidth' on every edge, built (and networkx imported) on first use
+        if self._graph is None:
+            import networkx as nx
+            G = nx.Graph()
+            G.add_nodes_from(range(self.number_of_nodes))
+            for i, (u, v, bandwidth, cost) in enumerate(self.topo_json['edge_list']):
+                G.add_edge(u, v, id = i, bandwidth = bandwidth)
+            self._graph = G
+        return self._graph
+
+    def get_edge_id(self, u, v):
+        return int(self.adjacency_edges[np.searchsorted(self.adjacency_keys, u * self.number_of_nodes + v)])
+
+    def _compute_routing(self):
+        # Level-by-level breadth-first search from every node. Neighbors and the nodes of a level are visited in
+        # the order of dicts filled the way networkx fills its adjacency and level dicts, so among equal-length
+        # paths a node keeps the predecessor networkx.single_source_shortest_path gives it.
+        number_of_nodes = self.number_of_nodes
+        neighbors = [{} for u in xrange(number_of_nodes)]
+        for edge in self.topo_json['edge_list']:
+            u, v = edge[:2]
+            neighbors[u][v] = None
+            neighbors[v][u] = None
+        neighbors = [list(adjacent) for adjacent in neighbors]
+        predecessor = np.full((number_of_nodes, number_of_nodes), -1, dtype=np.int32)
+        for source in xrange(number_of_nodes):
+            parent = {source: source}
+            nextlevel = {source: 1}
+            while nextlevel:
+                thislevel, nextlevel = nextlevel, {}
+                for u in thislevel:
+                    for v in neighbors[u]:
+                        if v not in parent:
+                            parent[v] = u
+                            nextlevel[v] = 1
+            del parent[source]
+            predecessor[source, parent.keys()] = parent.values()
+        # Every pair needs a path: hops, nearest servers and path walks have no value for a missing one
+        unreachable = (predecessor < 0).sum() - number_of_nodes
+        if unreachable:
+            raise ValueError("topology is disconnected, {} node pairs have no path".format(unreachable))
+
+        # Walk every reachable (source, target) pair back towards its source one hop per step, all pairs at once
+        sources, targets = np.nonzero(predecessor >= 0)
+        hops = np.zeros((number_of_nodes, number_of_nodes), dtype=np.int32)
+        pairs, current = sources * number_of_nodes + targets, targets
+        while len(pairs):
+            hops.flat[pairs] += 1
+            current = predecessor[pairs // number_of_nodes, current]
+            on_path = current != pairs // number_of_nodes
+            pairs, current = pairs[on_path], current[on_path]
+
+        # Incidence row of a pair lists its edge ids from source to target, filled from the target end
+        indptr = np.zeros(number_of_nodes * number_of_nodes + 1, dtype=np.int32)
+        np.cumsum(hops.ravel(), out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        pairs, current = sources * number_of_nodes + targets, targets
+        position = indptr[1:][pairs] - 1
+        while len(pairs):
+            previous = predecessor[sources, current]
+            indices[position] = self.adjacency_edges[np.searchsorted(self.adjacency_keys,
+                                                                     previous * number_of_nodes + current)]
+            on_path = previous != sources
+            sources, pairs, current, position = (sources[on_path], pairs[on_path], previous[on_path],
+                                                 position[on_path] - 1)
+        return {'predecessor': predecessor, 'hops': hops, 'incidence_indptr': indptr, 'incidence_indices': indices}
+
+    def get_path(self, x, y):
+        # Rebuild the node list of the x -> y path from the predecessor matrix, [] if x == y
+        if x == y:
+            return []
+        path = [y]
+        while y != x:
+            y = self.predecessor[x, y]
+            if y < 0:
+                raise ValueError("no path from {} to {}".format(x, path[0]))
+            path.append(y)
+        path.reverse()
+        return path
+
+    def get_bottleneck(self):
+        # bottleneck[x][y]: smallest link bandwidth on the x -> y path (0 if x == y), computed once per topology
+        if self._bottleneck is None:
+            number_of_nodes = self.number_of_nodes
+            indptr, indices = self.incidence.indptr, self.incidence.indices
+            bottleneck = np.zeros(number_of_nodes * number_of_nodes, dtype=self.state.bandwidth.dtype)
+            pairs = np.nonzero(np.diff(indptr))[0]
+            if len(pairs):
+                bottleneck[pairs] = np.minimum.reduceat(self.state.bandwidth[indices], indptr[pairs])
+            self._bottleneck = bottleneck.reshape(number_of_nodes, number_of_nodes)
+        return self._bottleneck
+
+    def get_nearest_server(self, pos, candidates=None):
+        # Closest server to pos, or closest of candidates (e.g. a channel's sites); ties go to the lower node id
+        if candidates is None:
+            return int(self.server_order[pos, 0])
+        return min(candidates, key=self.node_rank[pos].__getitem__)
+
+    def get_k_nearest_servers(self, pos, k, candidates=None):
+        if candidates is None:
+            return self.server_order[pos, :k].tolist()
+        return heapq.nsmallest(k, candidates, key=self.node_rank[pos].__getitem__)
 
     def get_links_on_path(self, x, y):
         links = []
-        path = self.routing[x][y]
+        path = self.get_path(x, y)
         for k in xrange(1, len(path)):
             links.append((path[k - 1], path[k]))
         return links
 
+    def pair_id(self, x, y):
+        return x * self.number_of_nodes + y
+
+    def get_edges_on_path(self, x, y):
+        # Edge ids on the x -> y path, read straight from the incidence row
+        pair = self.pair_id(x, y)
+        return self.incidence.indices[self.incidence.indptr[pair]:self.incidence.indptr[pair + 1]]
+
+    def path_batch(self):
+        return PathBatch(self)
+
+
+def topology_hash(topo_json):
+    return hashlib.sha1(json.dumps(topo_json, sort_keys=True)).hexdigest()
+
+
+def _load_routing(cache_path):
+    try:
+        # Plain ndarray views over the mapping, every process shares the same pages
+        return dict((name, np.asarray(np.load(os.path.join(cache_path, name + '.npy'), mmap_mode='r')))
+                    for name in ROUTING_ARRAYS)
+    except IOError:
+        return None
+
+
+def _save_routing(cache_path, arrays):
+    # Write into a scratch directory and rename it, so concurrent runs never see a partial table
+    parent = os.path.dirname(cache_path)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+    scratch = tempfile.mkdtemp(dir=parent)
+    for name in ROUTING_ARRAYS:
+        np.save(os.path.join(scratch, name + '.npy'), arrays[name])
+    try:
+        os.rename(scratch, cache_path)
+    except OSError:
+        # Another process cached the same topology first
+        shutil.rmtree(scratch)
+
+
+class PathBatch(object):
+    """Collects capacity/cost deltas per path and applies them to every link in one sparse mat-vec,
+    along with QoE deltas per (server, position) applied in one scatter-add."""
+    def __init__(self, topology):
+        self.topology = topology
+        self.pairs = []
+        self.deltas = []
+        self.qoe_cells = []
+        self.qoe_deltas = []
+
+    def add(self, x, y, capacity=0, cost=0):
+        self.pairs.append(self.topology.pair_id(x, y))
+        self.deltas.append((capacity, cost))
+
+    def add_qoe(self, server, position, delta):
+        self.qoe_cells.append((server, position))
+        self.qoe_deltas.append(delta)
+
+    def link_deltas(self):
+        # (number_of_edges x 2) array of aggregated capacity and cost deltas
+        if not self.pairs:
+            return np.zeros((self.topology.incidence.shape[1], 2), dtype=np.int64)
+        return self.topology.incidence[self.pairs].T.dot(np.array(self.deltas, dtype=np.int64))
+
+    def commit(self):
+        if self.pairs:
+            deltas = self.link_deltas()
+            self.topology.state.capacity += deltas[:, 0]
+            self.topology.state.cost += deltas[:, 1]
+        if self.qoe_cells:
+            self.topology.state.add_qoe(self.qoe_cells, self.qoe_deltas)
+        self.pairs = []
+        self.deltas = []
+        self.qoe_cells = []
+        self.qoe_deltas = []
+
 if __name__ == "__main__":
     with open('topo/nsfnet.json') as sample_topo:
         data = json.load(sample_topo)
         topology = Topology(data)
-        for node in topology.topo.nodes():
-            print topology.topo.node[node]
-        for u, v in topology.topo.edges_iter():
-            print topology.topo.edge[u][v]
-        print topology.routing
\ No newline at end of file
+        for u in xrange(topology.number_of_nodes):
+            for k in xrange(topology.adjacency_indptr[u], topology.adjacency_indptr[u + 1]):
+                edge = topology.adjacency_edges[k]
+                print (u, topology.adjacency_nodes[k]), {'id': edge, 'bandwidth': topology.state.bandwidth[edge]}
+        print topology.state.capacity, topology.state.cost
+        print topology.state.server
+        print topology.state.qoe
+        print topology.predecessor
+        print topology.hops
@@ -1,128 +1,348 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+import multiprocessing
 import os
 import random
+from tracefile import CompiledTrace, is_compiled_trace
+
+
+# Location name in the trace => node, used when the topology carries no "locations" table
+LOCATIONS = {"Palo Alto": 0,
+             "Seattle": 1,
+             "San Diego": 2,
+             "Salt Lake City": 3,
+             "Boulder": 4,
+             "Houston": 5,
+             "Lincoln": 6,
+             "Champaign": 7,
+             "Ann Arbor": 8,
+             "Pittsburgh": 9,
+             "Atlanta": 10,
+             "Ithaca": 11,
+             "College Park": 12,
+             "Princeton": 13}
 
 
 class Trace(object):
-    def __init__(self, dir):
-        # viewer_id => [position, channel_id, access_id]
+    def __init__(self, dir, rng=random, verbose=True, locations=None, workers=1):
+        # Either a directory of text round files or a file written by tracefile.py, None when rounds
+        # are pushed from a stream
+        self.dir = dir
+        # Location name => node table the round files are parsed against
+        self.locations = LOCATIONS if locations is None else locations
+        # workers > 1 parses the text round files ahead in that many processes
+        self.workers = workers
+        self._pool = None
+        self._parsed = None
+        # pid of the process that started _pool
+        self._pool_pid = None
+        # Source of viewer TTLs and departures, pass a seeded random.Random for reproducible runs
+        self.rng = rng
+        self.verbose = verbose
+        self._compiled = None
+        if dir is not None and os.path.isfile(dir) and is_compiled_trace(dir):
+            self._compiled = CompiledTrace(dir)
+        # liveId strings are interned to dense integer channel ids as they are read
+        self.channel_ids = {}
+        self.channel_names = []
+        # viewer_id => [position, channel_id, access_id], dropped once the viewer's leave event is consumed
         self.viewers = defaultdict(list)
-        # channel_id => source
+        # channel_id => source, dropped once the channel's leave event is consumed
         self.channels = defaultdict(int)
-        # timestamp => [[joining channels], [leaving channels], [joining users], [leaving users]]
-        self.events = [[] for _ in xrange(20)]
-        # read from traces in a directory
-        self._read_from_directory(dir)
+        # Number of rounds read so far
+        self.round_no = 0
 
-    def _get_expovariate_ttl(self):
-        return int(random.expovariate(0.5)+1)
+        # Churn bookkeeping carried from one round to the next
+        # channel_id => seen in the current round
+        self._live_channels = defaultdict(bool)
+        self._viewer_seq = 0
+        # [channel_id -> [viewer_id]] per position, unordered so a viewer leaves by swap-remove. Audience drops
+        # pick with rng.choice from this order, so seeded runs drop other viewers than with insertion-ordered lists.
+        self._viewer_set = [defaultdict(list) for _ in xrange(max(self.locations.itervalues()) + 1)]
+        # viewer_id => slot in its viewer_set list, for live viewers only
+        self._viewer_index = {}
+        # Timing wheel: round => viewers whose TTL runs out in that round. Viewers that left earlier stay
+        # in their bucket and are skipped when it expires.
+        self._expiry = defaultdict(list)
+        # Events handed out last round, released when the next round is requested
+        self._last_events = None
+        # seq timestamp of every event handed out last round, same layout as the events. Leaves happen
+        # at the round's first seq, joins at the seq of the record that brought them in.
+        self.event_times = None
 
-    def _get_uniform_ttl(self):
-        return int(random.uniform(1, 20))
-
-    def _read_from_directory(self, dir):
-        # prepare temporary data structures
-        map = {"Palo Alto": 0,
-               "Seattle": 1,
-               "San Diego": 2,
-               "Salt Lake City": 3,
-               "Boulder": 4,
-               "Houston": 5,
-               "Lincoln": 6,
-               "Champaign": 7,
-               "Ann Arbor": 8,
-               "Pittsburgh": 9,
-               "Atlanta": 10,
-               "Ithaca": 11,
-               "College Park": 12,
-               "Princeton": 13}
-        channels = defaultdict(bool)
-        viewer_seq = 0
-        viewer_set = [defaultdict(list) for _ in xrange(len(map))]
-        viewer_ttl = defaultdict(int)
-
-        trace_no = 0
+    def __getstate__(self):
+        # The compiled trace is reopened from its path, the module-level random is saved by its state
+        state = dict(self.__dict__)
+        state['_compiled'] = self._compiled is not None
+        # Parsing ahead starts again from the saved round
+        state['_pool'] = state['_parsed'] = None
+        if self.rng is random:
+            state['rng'] = random.getstate()
+            state['_module_rng'] = True
+        return state
+
+    def __setstate__(self, state):
+        if state.pop('_module_rng', False):
+            random.setstate(state['rng'])
+            state['rng'] = random
+        self.__dict__.update(state)
+        if self._compiled:
+            self._compiled = CompiledTrace(self.dir)
+        else:
+            self._compiled = None
+
+    @property
+    def number_of_channels(self):
+        # Upper bound on the channel ids handed out so far
+        if self._compiled is not None:
+            return len(self._compiled.channel_name_offsets) - 1
+        return len(self.channel_names)
+
+    def channel_name(self, channel):
+        if self._compiled is not None:
+            return self._compiled.channel_name(channel)
+        return self.channel_names[channel]
+
+    def _intern(self, live_id):
+        channel = self.channel_ids.get(live_id)
+        if channel is None:
+            channel = self.channel_ids[live_id] = len(self.channel_names)
+            self.channel_names.append(live_id)
+        return channel
+
+    def iter_rounds(self):
+        # Yield [[joining channels], [leaving channels], [joining users], [leaving users]] one round at a time
         while True:
-            read_path = str(dir) + str(trace_no+1)
+            events = self.next_round()
+            if events is None:
+                return
+            yield events
+
+    def next_round(self):
+        self._release_last_round()
+        if self._compiled is not None:
+            if self.round_no == self._compiled.rounds:
+                if self.verbose:
+                    print "END"
+                return None
+            events = self._load_compiled_round(self.round_no)
+            # Compiled traces keep no seq, every event happens at the round number
+            self.event_times = [[float(self.round_no + 1)] * len(kind) for kind in events]
+        else:
+            read_path = str(self.dir) + str(self.round_no + 1)
             if not os.path.isfile(read_path):
-                print "END"
+                self.close()
+                if self.verbose:
+                    print "END"
+                return None
+            events = self._read_round(read_path, self._parse(read_path))
+        self._last_events = events
+        self.round_no += 1
+        return events
+
+    def push_round(self, lines, name='stream'):
+        # Next round from s/v records already in memory, for live streams instead of round files
+        self._release_last_round()
+        events = self._read_round(name, parse_lines(lines, self.locations))
+        self._last_events = events
+        self.round_no += 1
+        return events
+
+    def close(self):
+        # Stop the parsing workers, if any, once the rounds they are still parsing are done
+        self._drop_inherited_pool()
+        if self._pool is not None:
+            for parsed in self._parsed:
+                parsed.wait()
+            self._pool.close()
+            self._pool.join()
+            self._pool = self._parsed = None
+
+    def _parse(self, read_path):
+        if self.workers <= 1:
+            return parse_round(read_path, self.locations)
+        self._drop_inherited_pool()
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers)
+            self._pool_pid = os.getpid()
+            # AsyncResults of the round files handed to the workers, in round order
+            self._parsed = deque()
+        # Keep a window of self.workers rounds queued from this one on, so parsing runs ahead of the churn
+        # bookkeeping but never holds more than that many parsed rounds
+        round_no = self.round_no + 1 + len(self._parsed)
+        while len(self._parsed) < self.workers:
+            path = str(self.dir) + str(round_no)
+            if not os.path.isfile(path):
                 break
+            self._parsed.append(self._pool.apply_async(parse_round, (path, self.locations)))
+            round_no += 1
+        return self._parsed.popleft().get()
+
+    def _drop_inherited_pool(self):
+        # A forked child (checkpoint.run_forked) inherits the pool object but not its handler threads, so it
+        # parses on a pool of its own and leaves the workers to the process that started them
+        if self._pool is not None and self._pool_pid != os.getpid():
+            self._pool = self._parsed = None
 
-            # Initialize events for current timestamp
-            self.events[trace_no] = [[], [], [], []]
-
-            request = [defaultdict(int) for _ in xrange(len(map))]
-
-            trace = open(read_path, 'r')
-            line = trace.readline()
-            while line != "":
-                seq, cType, cPos, cPosState, cTarget, cTargetState, liveId = line.strip().split(',')
-                pos, target = map[cPos], map[cTarget]
-                if cType == "s":
-                    if liveId not in channels:
-                        # Append new channel
-                        self.events[trace_no][0].append(liveId)
-                        self.channels[liveId] = pos
-                    channels[liveId] = True
-                elif cType == "v":
-                    request[pos][liveId] += 1
-                line = trace.readline()
-
-            for channel in channels:
-                if not channels[channel]:
-                    # Leaving channel
-                    self.events[trace_no][1].append(channel)
-                    # Leaving viewer who are watching leaving channel
-                    for i in xrange(len(viewer_set)):
-                        if channel in viewer_set[i]:
-                            for viewer_id in viewer_set[i][channel]:
-                                del viewer_ttl[viewer_id]
-                                self.events[trace_no][3].append(viewer_id)
-                            del viewer_set[i][channel]
-            for channel in self.events[trace_no][1]:
-                del channels[channel]
-
-            for i in xrange(len(viewer_set)):
-                for channel, viewer_list in viewer_set[i].iteritems():
-                    to_remove = []
-                    for viewer_id in viewer_list:
-                        if viewer_ttl[viewer_id] == 1:
-                            # If viewer has only 1 round left
-                            to_remove.append(viewer_id)
-                        else:
-                            # Decrease viewer TTL
-                            viewer_ttl[viewer_id] -= 1
-                    for viewer_id in to_remove:
-                        # Leaving viewer
-                        viewer_list.remove(viewer_id)
-                        del viewer_ttl[viewer_id]
-                    self.events[trace_no][3] += to_remove
-
-            for i in xrange(len(request)):
-                for channel, request_no in request[i].iteritems():
-                    viewer_list = viewer_set[i][channel]
-                    if request_no == len(viewer_list):
-                        # No need to increase or remove viewers
-                        continue
-                    elif request_no < len(viewer_list):
-                        # Need to remove viewers
-                        while request_no < len(viewer_list):
-                            to_remove = random.choice(viewer_list)
-                            viewer_list.remove(to_remove)
-                            del viewer_ttl[to_remove]
-                            self.events[trace_no][3].append(to_remove)
-                    else:
-                        # Need to add new viewers
-                        for _ in xrange(request_no - len(viewer_list)):
-                            viewer_list.append(viewer_seq)
-                            viewer_ttl[viewer_seq] = self._get_expovariate_ttl()
-                            self.events[trace_no][2].append(viewer_seq)
-                            self.viewers[viewer_seq] = [i, channel, None]
-                            viewer_seq += 1
-
-            # Set all channel to expiring as default in this round
-            for channel in channels:
-                channels[channel] = False
+    def _release_last_round(self):
+        if self._last_events is None:
+            return
+        for channel in self._last_events[1]:
+            del self.channels[channel]
+        for viewer_id in self._last_events[3]:
+            del self.viewers[viewer_id]
+        self._last_events = None
 
+    def _load_compiled_round(self, round_no):
+        # Joins, leaves and TTL churn were fixed at compile time, only records need restoring
+        compiled = self._compiled
+        events = [[], [], [], []]
+        events[0] = compiled.round_slice('channel_join', round_no).tolist()
+        first, last = compiled.channel_join_offsets[round_no], compiled.channel_join_offsets[round_no + 1]
+        for channel, source in zip(events[0], compiled.channel_join_source[first:last].tolist()):
+            self.channels[channel] = source
+        events[1] = compiled.round_slice('channel_leave', round_no).tolist()
+        first, last = compiled.viewer_join_offsets[round_no], compiled.viewer_join_offsets[round_no + 1]
+        events[2] = range(first, last)
+        positions = compiled.viewer_position[first:last].tolist()
+        channels = compiled.viewer_channel[first:last].tolist()
+        for viewer_id, position, channel in zip(events[2], positions, channels):
+            self.viewers[viewer_id] = [position, channel, None]
+        events[3] = compiled.round_slice('viewer_leave', round_no).tolist()
+        return events
+
+    def _get_expovariate_ttl(self):
+        return int(self.rng.expovariate(0.5)+1)
+
+    def _get_uniform_ttl(self):
+        return int(self.rng.uniform(1, 20))
+
+    def _remove_viewer(self, viewer_id, viewer_list):
+        # The list's last viewer takes the leaving viewer's slot
+        index = self._viewer_index.pop(viewer_id)
+        last = viewer_list.pop()
+        if last != viewer_id:
+            viewer_list[index] = last
+            self._viewer_index[last] = index
+
+    def _read_round(self, read_path, parsed):
+        # Churn bookkeeping on a parsed round file, in file order, so channel ids and random draws
+        # do not depend on how the file was parsed
+        channels = self._live_channels
+        viewer_set = self._viewer_set
+        viewer_index = self._viewer_index
+        round_no = self.round_no + 1
+        events = [[], [], [], []]
+
+        live_ids, sources, requests = parsed
+        # Departures happen at the round's first seq
+        start = min([seq for _, _, seq in sources] + [min(request_times) for _, _, request_times in requests] or
+                    [float(round_no)])
+        times = [[], [], [], []]
+        for live_id in live_ids:
+            self._intern(live_id)
+        # channel_id => seq of a channel that joins this round
+        join_time = {}
+        for live_id, pos, seq in sources:
+            channel = self.channel_ids[live_id]
+            if channel not in channels:
+                # Append new channel
+                events[0].append(channel)
+                times[0].append(seq)
+                join_time[channel] = seq
+                self.channels[channel] = pos
+            channels[channel] = True
+        request = [defaultdict(list) for _ in xrange(len(viewer_set))]
+        for pos, live_id, request_times in requests:
+            request[pos][self.channel_ids[live_id]] += request_times
+
+        for channel in channels:
+            if not channels[channel]:
+                # Leaving channel
+                events[1].append(channel)
+                # Leaving viewer who are watching leaving channel
+                for i in xrange(len(viewer_set)):
+                    if channel in viewer_set[i]:
+                        for viewer_id in viewer_set[i][channel]:
+                            del viewer_index[viewer_id]
+                            events[3].append(viewer_id)
+                        del viewer_set[i][channel]
+        for channel in events[1]:
+            del channels[channel]
+
+        # Viewers whose TTL ends this round
+        for viewer_id in self._expiry.pop(round_no, ()):
+            if viewer_id in viewer_index:
+                position, channel = self.viewers[viewer_id][:2]
+                self._remove_viewer(viewer_id, viewer_set[position][channel])
+                events[3].append(viewer_id)
+
+        for i in xrange(len(request)):
+            for channel, request_times in request[i].iteritems():
+                request_no = len(request_times)
+                viewer_list = viewer_set[i][channel]
+                if request_no == len(viewer_list):
+                    # No need to increase or remove viewers
+                    continue
+                elif request_no < len(viewer_list):
+                    # Need to remove viewers
+                    while request_no < len(viewer_list):
+                        to_remove = self.rng.choice(viewer_list)
+                        self._remove_viewer(to_remove, viewer_list)
+                        events[3].append(to_remove)
+                else:
+                    # Need to add new viewers, they arrive with the latest records, never before their channel
+                    request_times.sort()
+                    earliest = join_time.get(channel, start)
+                    times[2] += [max(seq, earliest) for seq in request_times[len(viewer_list):]]
+                    for _ in xrange(request_no - len(viewer_list)):
+                        viewer_index[self._viewer_seq] = len(viewer_list)
+                        viewer_list.append(self._viewer_seq)
+                        self._expiry[round_no + self._get_expovariate_ttl()].append(self._viewer_seq)
+                        events[2].append(self._viewer_seq)
+                        self.viewers[self._viewer_seq] = [i, channel, None]
+                        self._viewer_seq += 1
+
+        # Set all channel to expiring as default in this round
+        for channel in channels:
+            channels[channel] = False
+        times[1] = [start] * len(events[1])
+        times[3] = [start] * len(events[3])
+        self.event_times = times
+
+        if self.verbose:
             print "{} done".format(read_path)
-            trace_no += 1
\ No newline at end of file
+        return events
+
+
+def parse_round(read_path, locations):
+    # Stateless part of reading a round file, safe to run in any process
+    trace = open(read_path, 'r')
+    parsed = parse_lines(trace, locations)
+    trace.close()
+    return parsed
+
+
+def parse_lines(lines, locations):
+    # liveIds in order of first appearance, [(liveId, source position, seq)] of the first s line of each
+    # channel, and [(position, liveId, [seq of every v line])] in order of first appearance
+    live_ids, seen = [], set()
+    sources, has_source = [], set()
+    requests, request_times = [], {}
+    for line in lines:
+        seq, cType, cPos, cPosState, cTarget, cTargetState, liveId = line.strip().split(',')
+        pos, target = locations[cPos], locations[cTarget]
+        if liveId not in seen:
+            seen.add(liveId)
+            live_ids.append(liveId)
+        if cType == "s":
+            if liveId not in has_source:
+                has_source.add(liveId)
+                sources.append((liveId, pos, float(seq)))
+        elif cType == "v":
+            key = (pos, liveId)
+            if key not in request_times:
+                request_times[key] = []
+                requests.append(key)
+            request_times[key].append(float(seq))
+    return live_ids, sources, [(pos, liveId, request_times[(pos, liveId)]) for pos, liveId in requests]
+
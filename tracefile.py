@@ -0,0 +1,130 @@
+#!/usr/bin/python
+import json
+import struct
+import sys
+import numpy as np
+
+# Layout: MAGIC, uint64 header length, JSON header, then 8-byte aligned columns.
+# The header maps each column name to [dtype, byte offset, number of items].
+# Bumped whenever the columns change, files written under an older magic are refused
+MAGIC = 'SIMLIVE2'
+MAGIC_PREFIX = 'SIMLIVE'
+ALIGN = 8
+
+# Column name => dtype
+COLUMNS = [('channel_names', np.uint8),          # concatenated liveId strings
+           ('channel_name_offsets', np.int64),   # channel => slice into channel_names
+           ('channel_join_offsets', np.int64),   # round => slice into channel_join
+           ('channel_join', np.int32),
+           ('channel_join_source', np.int32),    # source position of each channel join
+           ('channel_leave_offsets', np.int64),  # round => slice into channel_leave
+           ('channel_leave', np.int32),
+           ('viewer_join_offsets', np.int64),    # round => first viewer id joining, viewer ids are sequential
+           ('viewer_position', np.int32),        # viewer => position
+           ('viewer_channel', np.int32),         # viewer => channel
+           ('viewer_leave_offsets', np.int64),   # round => slice into viewer_leave
+           ('viewer_leave', np.int64)]
+
+
+def compile_trace(trace, out_path):
+    # Replay a text trace once, freezing its joins, leaves and TTL churn into columns
+    columns = dict((name, []) for name, _ in COLUMNS)
+    for offsets in ('channel_join_offsets', 'channel_leave_offsets', 'viewer_join_offsets', 'viewer_leave_offsets'):
+        columns[offsets].append(0)
+
+    for events in trace.iter_rounds():
+        columns['channel_join'] += events[0]
+        columns['channel_join_source'] += [trace.channels[channel] for channel in events[0]]
+        columns['channel_leave'] += events[1]
+        for viewer_id in events[2]:
+            position, channel, _ = trace.viewers[viewer_id]
+            columns['viewer_position'].append(position)
+            columns['viewer_channel'].append(channel)
+        columns['viewer_leave'] += events[3]
+
+        columns['channel_join_offsets'].append(len(columns['channel_join']))
+        columns['channel_leave_offsets'].append(len(columns['channel_leave']))
+        columns['viewer_join_offsets'].append(len(columns['viewer_position']))
+        columns['viewer_leave_offsets'].append(len(columns['viewer_leave']))
+
+    # Channel ids are the trace's interned ids, so names are indexed by them directly
+    names = [trace.channel_name(channel) for channel in xrange(trace.number_of_channels)]
+    columns['channel_names'] = np.frombuffer(''.join(names), dtype=np.uint8)
+    columns['channel_name_offsets'] = np.cumsum([0] + [len(name) for name in names])
+    write_columns(out_path, columns, len(columns['channel_join_offsets']) - 1)
+
+
+def write_columns(out_path, columns, rounds):
+    arrays = [(name, np.asarray(columns[name], dtype=dtype)) for name, dtype in COLUMNS]
+
+    # Header size depends on the offsets it records, so grow the data start until the header fits
+    data_start = 0
+    while True:
+        layout, position = {}, data_start
+        for name, array in arrays:
+            layout[name] = [array.dtype.str, position, len(array)]
+            position += _padded(array.nbytes)
+        header = json.dumps({'rounds': rounds, 'arrays': layout})
+        if len(MAGIC) + 8 + len(header) <= data_start:
+            break
+        data_start = _padded(len(MAGIC) + 8 + len(header))
+    header += ' ' * (data_start - len(MAGIC) - 8 - len(header))
+
+    with open(out_path, 'wb') as out:
+        out.write(MAGIC)
+        out.write(struct.pack('<Q', len(header)))
+        out.write(header)
+        for name, array in arrays:
+            out.write(array.tostring())
+            out.write('\0' * (_padded(array.nbytes) - array.nbytes))
+
+
+def _padded(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+def is_compiled_trace(path):
+    # Any version, so an outdated file is reported instead of being read as a text round
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)).startswith(MAGIC_PREFIX)
+
+
+class CompiledTrace(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                if magic.startswith(MAGIC_PREFIX):
+                    raise ValueError("{} was compiled as {}, this version reads {}, recompile it".format(
+                        path, magic, MAGIC))
+                raise ValueError("{} is not a compiled trace".format(path))
+            header_length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_length))
+        self.rounds = header['rounds']
+        self._names = {}
+        # Columns are memory-mapped read-only, nothing is parsed up front
+        for name, (dtype, offset, length) in header['arrays'].iteritems():
+            if length == 0:
+                column = np.zeros(0, dtype=dtype)
+            else:
+                column = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(length,))
+            setattr(self, name, column)
+
+    def channel_name(self, channel):
+        # Names are decoded on first use only
+        if channel not in self._names:
+            start, end = self.channel_name_offsets[channel], self.channel_name_offsets[channel + 1]
+            self._names[channel] = self.channel_names[start:end].tostring()
+        return self._names[channel]
+
+    def round_slice(self, column, round_no):
+        offsets = getattr(self, column + '_offsets')
+        return getattr(self, column)[offsets[round_no]:offsets[round_no + 1]]
+
+
+if __name__ == "__main__":
+    from trace import Trace
+    if len(sys.argv) != 3:
+        print "Usage: {} <trace directory> <output file>".format(sys.argv[0])
+        sys.exit(1)
+    compile_trace(Trace(sys.argv[1]), sys.argv[2])